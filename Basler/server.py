@@ -5,22 +5,23 @@ import numpy as np
 import time
 import datetime
 import logging
-import os
-from scipy.ndimage import convolve
-from PIL import Image, ImageDraw, ImageFont
-from threading import Thread
-from queue import Queue
-import csv
+from threading import Thread, Event
 import platform
 from common.config import basler_server_config
 from common.logger_adapter import LoggerAdapter
-from common.other import generate_basename
-from common.shared_server_side import add_center_of_mass_functions
+from common.frame_buffer import FrameRingBuffer
+from common.overlay import MarkOverlay
+from common.hot_spot import HotSpotFinder, draw_rectangle
+from common.image_transform import OrientationPlan
+from common.camera_pipeline import CameraPipeline
+from common.shared_server_side import add_center_of_mass_functions, add_preview_functions, add_stage_timing_functions
 # -----------------------------
 
 
 @add_center_of_mass_functions
-class Basler(Device):
+@add_preview_functions
+@add_stage_timing_functions
+class Basler(CameraPipeline, Device):
     '''
     is_polling_periodically attribute. If is_polling_periodically is False, the polling is manually controlled by the acquisition script, else the polling is made by the polling period "polling".
     '''
@@ -161,40 +162,6 @@ class Basler(Device):
         doc='polling the image periodically or by external acquisition code'
     )
 
-    save_data = attribute(
-        label="save data",
-        dtype=bool,
-        access=AttrWriteType.READ_WRITE,
-        memorized=is_memorized,
-        hw_memorized=True,
-        doc='save the images on the server'
-    )
-
-    save_path = attribute(
-        label='save path (folder)',
-        dtype=str,
-        access=AttrWriteType.READ_WRITE,
-        memorized=is_memorized,
-        hw_memorized=True,
-        doc='Save data path on the server. Use %date to indicate today; Use ";" to separate multiple paths'
-    )
-
-    save_interval = attribute(
-        label='save interval',
-        dtype=float,
-        access=AttrWriteType.READ_WRITE,
-        unit='s',
-        memorized=is_memorized,
-        hw_memorized=True,
-        doc='If the trigger interval is longer than the save_interval threshold, images will be saved. Otherwise, no saving.'
-    )
-
-    def read_save_interval(self):
-        return self._save_interval
-
-    def write_save_interval(self, value):
-        self._save_interval = value
-
     resulting_fps = attribute(
         label="resulting frame rate",
         dtype=float,
@@ -241,21 +208,6 @@ class Basler(Device):
         self.camera.GevSCPD.SetValue(value)
         self._inner_packet_delay = value
 
-    naming_format = attribute(
-        label='naming format',
-        dtype=str,
-        access=AttrWriteType.READ_WRITE,
-        memorized=is_memorized,
-        hw_memorized=True,
-        doc='Naming format for the image file. For example, "%s_%t_%e_%h.%f", where %s is for shot number, %t is for timestamp, %e is for energy, %h is for hot spot, %f is tiff'
-    )
-
-    def read_naming_format(self):
-        return self._naming_format
-
-    def write_naming_format(self, value):
-        self._naming_format = value
-
     lr_flip = attribute(
         label='lr flip',
         dtype=bool,
@@ -270,6 +222,7 @@ class Basler(Device):
 
     def write_lr_flip(self, value):
         self._lr_flip = value
+        self._update_orientation()
 
     ud_flip = attribute(
         label='ud flip',
@@ -285,6 +238,7 @@ class Basler(Device):
 
     def write_ud_flip(self, value):
         self._ud_flip = value
+        self._update_orientation()
 
     rotate = attribute(
         label='rotate',
@@ -301,9 +255,14 @@ class Basler(Device):
     def write_rotate(self, value):
         if value in [0, 90, 180, 270]:
             self._rotate = value
+            self._update_orientation()
         else:
             raise Exception('Must be 0, 90, 180 or 270.')
 
+    def _update_orientation(self):
+        self.orientation = OrientationPlan(
+            self._lr_flip, self._ud_flip, self._rotate)
+
     exposure = attribute(
         name="exposure",
         label="exposure",
@@ -385,6 +344,91 @@ class Basler(Device):
         access=AttrWriteType.READ,
     )
 
+    frame_buffer_size = attribute(
+        label='frame buffer size',
+        dtype=int,
+        access=AttrWriteType.READ_WRITE,
+        memorized=is_memorized,
+        hw_memorized=True,
+        doc='Number of preallocated frame slots between the grab thread and the image processing. What happens when the buffer is full is set by frame_buffer_policy.'
+    )
+
+    def read_frame_buffer_size(self):
+        return self.frame_buffer.capacity
+
+    def write_frame_buffer_size(self, value):
+        if value < 1:
+            raise Exception('Must be at least 1.')
+        if value != self.frame_buffer.capacity:
+            self.frame_buffer.resize(value)
+
+    frame_buffer_policy = attribute(
+        label='frame buffer policy',
+        dtype=str,
+        access=AttrWriteType.READ_WRITE,
+        memorized=is_memorized,
+        hw_memorized=True,
+        doc='What happens to a new frame when the frame buffer is full. "auto" (default): "block" when the camera is triggered, "drop_oldest" in live mode. "drop_oldest": overwrite the oldest waiting frame. "drop_newest": discard the new frame. "block": the grab thread waits until a slot is free, so the frames wait in the pylon buffers instead. Frames are numbered when they are grabbed, so a dropped triggered frame leaves a gap in image_number.'
+    )
+
+    def read_frame_buffer_policy(self):
+        return self._frame_buffer_policy
+
+    def write_frame_buffer_policy(self, value):
+        if value != 'auto' and value not in FrameRingBuffer.policies:
+            raise Exception(
+                f'Must be one of auto, {", ".join(FrameRingBuffer.policies)}.')
+        self._frame_buffer_policy = value
+        self._apply_frame_buffer_policy()
+
+    def _apply_frame_buffer_policy(self):
+        '''cache the trigger mode for the grab thread and choose the policy of "auto". Triggered frames are shots and must not be overwritten.'''
+        self._is_triggered = self.read_trigger_source('').lower() != 'off'
+        if self._frame_buffer_policy == 'auto':
+            self.frame_buffer.policy = 'block' if self._is_triggered else 'drop_oldest'
+        else:
+            self.frame_buffer.policy = self._frame_buffer_policy
+
+    frame_buffer_peak = attribute(
+        label='frame buffer peak',
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc='Highest number of frames waiting in the frame buffer since the last reset_number.'
+    )
+
+    def read_frame_buffer_peak(self):
+        return self.frame_buffer.peak_occupancy
+
+    frames_dropped = attribute(
+        label='frames dropped',
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc='Frames retrieved from the camera but overwritten in the frame buffer before being processed. In live mode, skipped intermediate frames are also counted.'
+    )
+
+    def read_frames_dropped(self):
+        return self.frame_buffer.dropped
+
+    frames_processed = attribute(
+        label='frames processed',
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc='Frames taken from the frame buffer and processed.'
+    )
+
+    def read_frames_processed(self):
+        return self.frame_buffer.processed
+
+    frames_queued = attribute(
+        label='frames queued',
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc='Frames waiting in the frame buffer.'
+    )
+
+    def read_frames_queued(self):
+        return self.frame_buffer.queued
+
     is_debug_mode = attribute(
         label='debug',
         dtype=bool,
@@ -519,24 +563,15 @@ class Basler(Device):
         self.add_attribute(trigger_source)
         if self.extra_script == "center_of_mass":
             self.initialize_center_of_mass_attributes()
+        self.initialize_saving_attributes()
+        self.initialize_preview_attributes()
+        self.initialize_stage_timing_attributes()
         # self.add_attribute("trigger_source")
         # if self.camera.DeviceModelName() in ['acA640-121gm']:
 
     def read_image_with_MeV_mark(self, attr):
         return self._image_with_MeV_mark
 
-    def draw_dash_line(self, draw, start, end, period_length=40, ratio=0.5):
-        number = int(((end[0] - start[0])**2 +
-                     (end[1] - start[1])**2)**0.5/period_length)
-        arc = np.arctan2(end[1] - start[1], end[0] - start[0])
-        dx, dy = period_length*np.cos(arc), period_length*np.sin(arc)
-        for i in range(number):
-            line_start = (np.array(start)+[i*dx, i*dy]).astype(int)
-            line_end = (np.array(start) +
-                        [i*dx+dx*ratio, i*dy+dy*ratio]).astype(int)
-            draw.line([tuple(line_start), tuple(line_end)],
-                      fill=int(np.max(self._image)), width=5)
-
     def read_exposure(self):
         try:
             self._exposure = self.camera.ExposureTime.Value
@@ -641,14 +676,13 @@ class Basler(Device):
         self._host_computer = platform.node()
         self.filter_option_details = {
             "1": [27.53, 26.988, 0.8455, 27.53, 24.540], "2": [23.24, 21.370, 0.827, 23.24, 20.641]}
-        self.path_raw = ''
         self._is_polling_periodically = False
         self._debug = False
-        self._save_data = False
-        self._save_path = ''
-        self._naming_format = '%t.%f'
-        self._save_interval = 0
         self._image_number = 0
+        # number of the last triggered frame grabbed. Frames are numbered by the grab thread, so that dropped frames leave gaps in image_number.
+        self._grabbed_number = 0
+        self._is_triggered = False
+        self._frame_buffer_policy = 'auto'
         self._energy = 0
         self._hot_spot = 0
         self._read_time = 'N/A'
@@ -656,11 +690,14 @@ class Basler(Device):
         self._lr_flip = False
         self._ud_flip = False
         self._rotate = 0
+        self._update_orientation()
+        self.init_pipeline(['CoM', 'calibration', 'overlay'])
         self._frames_per_trigger = 1
         self._repetition = 50
         super().init_device()
         self.set_state(DevState.INIT)
         self._close_camera()
+        self.frame_buffer = FrameRingBuffer(16)
         # force disable polling for "image" in DB
         self.disable_polling('image')
         try:
@@ -671,6 +708,7 @@ class Basler(Device):
             handlers = [logging.StreamHandler()]
             logging.basicConfig(handlers=handlers,
                                 format="%(asctime)s %(message)s", level=logging.INFO)
+            self.start_saving()
         except Exception as e:
             self.set_state(DevState.OFF)
             raise e
@@ -685,6 +723,7 @@ class Basler(Device):
             instance.CreateDevice(self.device))
         self.camera.Open()
         self._configure_camera_after_open()
+        self._start_acquisition_thread()
         print(
             f'Camera is connected. {self.device.GetUserDefinedName()}: {self.device.GetSerialNumber()}')
         self.set_state(DevState.ON)
@@ -714,6 +753,7 @@ class Basler(Device):
         self.camera.AcquisitionFrameRateEnable.SetValue(True)
         self.set_change_event("image", True, False)
         self.camera.MaxNumBuffer.SetValue(1000)
+        self._apply_frame_buffer_policy()
         self.leak_coe = 0.815
         self._calibration = 1
         self.clip_coe = 1
@@ -732,12 +772,60 @@ class Basler(Device):
         else:
             self._calibration = 0
             self._flux = np.zeros((2, 2))
+        if self._calibration:
+            self.hot_spot_finder = HotSpotFinder(self.kernel)
         self._has_MeV_mark = 0
         if self.serial_number in basler_server_config["mev_mark"]["serial_number"]:
             self._has_MeV_mark = 1
-        self.q = Queue()
+            self.MeV_mark_overlay = MarkOverlay(
+                [f'{i}G' for i in basler_server_config["mev_mark"]["energy_GeV"]], basler_server_config["mev_mark"]["pixel"])
+
+    def _start_acquisition_thread(self):
+        self._acquisition_stop = Event()
+        self._acquisition_thread = Thread(
+            target=self._acquisition_loop, daemon=True)
+        self._acquisition_thread.start()
+
+    def _stop_acquisition_thread(self):
+        if not hasattr(self, '_acquisition_thread'):
+            return
+        self._acquisition_stop.set()
+        self._acquisition_thread.join(timeout=2)
+
+    def _acquisition_loop(self):
+        '''Retrieve frames from pylon as soon as they arrive and copy them into the frame buffer, so that pylon's buffer pool is released independently of how fast the frames are processed.'''
+        while not self._acquisition_stop.is_set():
+            try:
+                if not self.camera.IsGrabbing():
+                    time.sleep(0.01)
+                    continue
+                grabResult = self.camera.RetrieveResult(
+                    100, pylon.TimeoutHandling_Return)
+            except Exception as e:
+                # grabbing may be stopped by another thread between IsGrabbing and RetrieveResult
+                if self._debug:
+                    self.logger.info(f'retrieve interrupted: {e}')
+                time.sleep(0.01)
+                continue
+            if grabResult and grabResult.GrabSucceeded():
+                grab_time = time.monotonic()
+                number = None
+                if self._is_triggered:
+                    self._grabbed_number += 1
+                    number = self._grabbed_number
+                if self.frame_buffer.policy == 'block':
+                    # the frame stays in its pylon buffer until a slot is free
+                    while not self.frame_buffer.wait_for_space(0.1) and not self._acquisition_stop.is_set():
+                        pass
+                with self.stage_timer.measure('retrieve'), grabResult.GetArrayZeroCopy() as array:
+                    self.frame_buffer.put(
+                        array, (grab_time, number), timeout=0)
+                self.announce_arrival()
+            if grabResult:
+                grabResult.Release()
 
     def _close_camera(self):
+        self._stop_acquisition_thread()
         if not hasattr(self, 'camera'):
             return
         try:
@@ -759,6 +847,7 @@ class Basler(Device):
 
     def delete_device(self):
         self._close_camera()
+        self.shutdown_pipeline()
         print("Camera is disconnected.")
         super().delete_device()
 
@@ -771,19 +860,6 @@ class Basler(Device):
     # def read_serial_number(self):
     #     return self.device.GetSerialNumber()
 
-    def read_save_data(self):
-        return self._save_data
-
-    def write_save_data(self, value):
-        if self._save_data != value:
-            self.logger.info(f'save status is changed to {value}')
-        self._save_data = value
-        if value:
-            try:
-                os.makedirs(self._save_path, exist_ok=True)
-            except FileNotFoundError:
-                return
-
     def read_is_polling_periodically(self):
         return self._is_polling_periodically
 
@@ -794,60 +870,18 @@ class Basler(Device):
         else:
             self.enable_polling('is_new_image')
 
-    def read_save_path(self):
-        if self._use_date and datetime.datetime.today().strftime("%Y%m%d") not in self._save_path:
-            self.write_save_path(self.path_raw)
-        return self._save_path
-
-    def write_save_path(self, value):
-        # if the entered path has %date in it, replace %date with today's date and mark a _use_date flag
-        self.path_raw = value
-        if '%date' in value:
-            self._use_date = True
-            value = value.replace(
-                '%date', datetime.datetime.today().strftime("%Y%m%d"))
-        else:
-            self._use_date = False
-        value_split = value.split(';')
-        if self._save_data:
-            for idx, v in enumerate(value_split):
-                try:
-                    os.makedirs(v, exist_ok=True)
-                except OSError as inst:
-                    logging.error(inst)
-                    raise Exception(f'error on save_path part {idx}')
-        self._save_path = value
-        self.push_change_event("save_path", self.read_save_path())
-
-    def get_settings(self):
+    def frame_settings(self):
         if self._calibration:
             self.csv_fieldnames = ['_read_time', '_image_number', '_energy', '_hot_spot', '_exposure', '_gain', '_binning_horizontal', '_binning_vertical', '_width',
                                    '_height', 'QE195_reading', 'mean_intensity_of_calibration_images', 'leak_coe', 'clip_coe', 'pixel_size']
         else:
             self.csv_fieldnames = ['_read_time', '_image_number',  '_exposure', '_gain',
                                    '_binning_horizontal', '_binning_vertical', '_width', '_height']
-        self.data_to_log = {}
+        data_to_log = {}
         for name in self.csv_fieldnames:
             if hasattr(self, name):
-                self.data_to_log[name] = str(getattr(self, name))
-
-    def save_settings(self, save_path, data_to_log):
-        '''write the important camera parameters and calibration data.'''
-        logging_file_path = os.path.join(save_path, 'logging.csv')
-        to_do = 'w'
-        # if the file exists and the existing data is same as the current data, then skip. If the file exists but the data is different, append with 'a' mode. Else, overwrite with 'w' mode.
-        if os.path.isfile(logging_file_path):
-            to_do = 'a'
-        try:
-            with open(logging_file_path, to_do, newline='') as csvfile:
-                writer = csv.DictWriter(
-                    csvfile, fieldnames=data_to_log.keys())
-                if to_do == 'w':
-                    writer.writeheader()
-                writer.writerow(data_to_log)
-        except ValueError:
-            self.logger.info(
-                f"Check the logging file at {logging_file_path}")
+                data_to_log[name] = str(getattr(self, name))
+        return data_to_log
 
     def read_model(self):
         self._model = self.camera.GetDeviceInfo().GetModelName()
@@ -920,6 +954,7 @@ class Basler(Device):
             else:
                 self.camera.TriggerSource.SetValue(
                     value.capitalize())
+        self._apply_frame_buffer_policy()
         self.get_ready()
 
     def read_frames_per_trigger(self):
@@ -998,178 +1033,82 @@ class Basler(Device):
 
     def read_is_new_image(self):
         # self.i, grabbing successfully grabbed image. self._image_number, image counting and can be reset at any time.
-        self._is_new_image = False
-        while self.camera.IsGrabbing():
-            # the retrieve time out may need to be reconsidered.
-            time0 = time.perf_counter()
-            grabResult = self.camera.RetrieveResult(
-                100, pylon.TimeoutHandling_Return)
-            if self._debug:
-                self.logger.info(f'grab takes {time.perf_counter() - time0}')
-            if grabResult and grabResult.GrabSucceeded():
-                if self.read_trigger_source("").lower() != "off":
-                    self.i += 1
-                    self._image_number += 1
-                    self.logger.info(
-                        f'{self.i}')
-                self._image = grabResult.Array
-                if len(self._image.shape) == 3:
-                    self._image_r = self._image[:, :, 0]
-                    self._image_g = self._image[:, :, 1]
-                    self._image_b = self._image[:, :, 2]
-                    # Convert to grayscale using the luminance formula (common weights)
-                    # Y = 0.299 * R + 0.587 * G + 0.114 * B
-                    self._image = 0.299*self._image_r + 0.587 * \
-                        self._image_g + 0.114 * self._image_b
-                if self._lr_flip:
-                    self._image = np.fliplr(self._image)
-                if self._ud_flip:
-                    self._image = np.flipud(self._image)
-                if self._rotate:
-                    self._image = np.rot90(self._image, int(self._rotate/90))
-                self.calculate_center_of_mass()
-                if self._calibration:
-                    self._energy = (np.sum(self._image)) * \
-                        self.energy_intensity_coefficient
-                    self._flux = (self._image) * self.energy_intensity_coefficient * self.clip_coe *\
-                        self.leak_coe/self.pixel_size**2
-                    convolved_image = convolve(
-                        self._flux, self.kernel, mode='constant')
-                    self._hot_spot = np.max(
-                        convolved_image)
-                    cy, cx = np.unravel_index(
-                        np.argmax(convolved_image), convolved_image.shape)
-                    dy, dx = self.kernel.shape
-                    min_value = np.min(self._flux)
-                    im_pil = Image.fromarray(self._flux)
-                    draw = ImageDraw.Draw(im_pil)
-                    enlarged_length = 4
-                    draw.rectangle([(max(0, int(cx-(dx+1+enlarged_length)/2)), max(int(cy-(dy+1+enlarged_length)/2), 0)), (min(int(cx+(dx+1+enlarged_length)/2),
-                                    convolved_image.shape[1]),  min(int(cy+(dy+1+enlarged_length)/2), convolved_image.shape[0]))], outline=min_value, width=3)
-                    self._flux = np.array(im_pil)
-                    self.flux_path_string = "flux_image_with_hot_spot"
-                if self._has_MeV_mark:
-                    ek = np.array([400,   600,  800,  1000, 1200, 1400, 1600,
-                                  1800, 2000, 2500, 3000, 3300, 3500, 3800, 4000, 4300])/1000
-                    ek_pixels = (72 - np.array([11.6, 23.5, 29.3, 34.1, 37.9, 42.9, 47.6,
-                                 51.4, 54.5, 60.3, 64.4, 66.3, 67.4, 68.8, 69.6, 70.8])) * 70 + 324
-                    ek_pixels = np.array([int(ek_pixels[i])
-                                         for i in range(len(ek_pixels))])
-                    im_pil = Image.fromarray(self._image)
-                    draw = ImageDraw.Draw(im_pil)
-                    font = ImageFont.truetype("arial.ttf", 80)
-                    for idx, (i, j) in enumerate(zip(ek, ek_pixels)):
-                        self.draw_dash_line(draw, [j, 0], [j, im_pil.size[0]])
-                        draw.text(
-                            (j-70, im_pil.size[1]-idx*50), str(i)+'G', font=font, fill=int(np.max(self._image)))
-                    self._image_with_MeV_mark = np.array(
-                        im_pil).astype(self._image.dtype)
-                    self.push_change_event(
-                        "image_with_MeV_mark", self.read_image_with_MeV_mark("placeholder"))
-                grabResult.Release()
-                if self._debug:
-                    self.logger.info(
-                        f"{self._image_number} new. mean intensity: {np.mean(self._image)}")
-
-                self._is_new_image = True
-                self._read_time = datetime.datetime.now().strftime("%H-%M-%S.%f")
-                # self.push_change_event("image", self._image)
-                self.push_change_event("image", self.read_image())
-                self.push_change_event("flux", self.read_flux())
-                self.push_change_event(
-                    "image_number", self.read_image_number())
-                self.push_change_event(
-                    "energy", self.read_energy())
-                self.push_change_event(
-                    "hot_spot", self.read_hot_spot())
-                # show image count while not in live mode
-                if self._save_data and self._save_path:
-                    parse_save_path = self._save_path.split(';')
-                    self.time1 = time.perf_counter()
-                    should_save = True
-                    if hasattr(self, 'time0'):
-                        self.time_interval = self.time1 - self.time0
-                        # ----create the interval threshold, read time attr
-                        if self.time_interval < self._save_interval:
-                            for path in parse_save_path:
-                                if os.path.exists(os.path.join(
-                                        path, self.image_basename)):
-                                    os.remove(os.path.join(
-                                        path, self.image_basename))
-                                    try:
-                                        with open(os.path.join(path, 'logging.csv'), "r+") as f:
-                                            current_position = previous_position = f.tell()
-                                            while f.readline():
-                                                previous_position = current_position
-                                                current_position = f.tell()
-                                            f.truncate(previous_position)
-                                    except ValueError:
-                                        self.logger.info(
-                                            f"Check the logging file at {os.path.join(path, 'logging.csv')}")
-                                    self.logger.info(
-                                        f"Removed previous saved image {self.image_basename}")
-                                if self._calibration:
-                                    if os.path.exists(os.path.join(
-                                            path, self.flux_path_string, self.image_basename)):
-                                        os.remove(os.path.join(
-                                            path, self.flux_path_string, self.image_basename))
-                                should_save = False
-                    self.time0 = self.time1
-                    # generate file name after delete the old file name
-                    self.image_basename = generate_basename(
-                        self._naming_format, {'%s': f'ImageNum{self._image_number}', '%t': f'Time{self._read_time}', '%e': f'Energy{self._energy:.3f}J', '%h': f'HotSpot{self._hot_spot:.4f}Jcm-2', '%f': 'tiff'})
-                    if should_save:
-                        data = Image.fromarray(self._image)
-                        self.q.put(data)
-                        self.get_settings()
-                        self.q.put(self.data_to_log)
-                        if self._calibration:
-                            self.q.put(im_pil)
-                            # self.q.put(Image.fromarray(convolved_image))
-                        Thread(target=self.save_image_to_file,
-                               args=[self.q]).start()
-            return self._is_new_image
-        # return False if there is no new image
+        # Frames are retrieved by the acquisition thread. Each read processes and publishes one buffered frame, so that every True corresponds to exactly one image for the acquisition script.
+        self._is_new_image = self.process_next_frame()
         return self._is_new_image
 
-    def save_image_to_file(self, q):
-        parse_save_path = self._save_path.split(';')
-        image_to_save = q.get()
-        data_to_log = q.get()
+    def acquire_frame(self):
+        if not len(self.frame_buffer):
+            return None, None
+        # in live mode only the latest frame is of interest
+        is_live = self.read_trigger_source("").lower() == "off"
+        frame, meta = self.frame_buffer.get(latest=is_live)
+        if frame is None:
+            return None, None
+        grab_time, number = meta
+        if number is not None:
+            self.i += 1
+            self._image_number = number
+            self.logger.info(
+                f'{self.i}')
+        self._read_time = datetime.datetime.now().strftime("%H-%M-%S.%f")
+        return frame, grab_time
+
+    def analyse_frame(self):
+        timer = self.stage_timer
+        with timer.measure('CoM'):
+            self.calculate_center_of_mass()
         if self._calibration:
-            flux_to_save = q.get()
-        for path in parse_save_path:
-            os.makedirs(path, exist_ok=True)
-            path_to_name = os.path.join(
-                path, self.image_basename)
-            image_to_save.save(path_to_name)
+            with timer.measure('calibration'):
+                self._energy = (np.sum(self._image)) * \
+                    self.energy_intensity_coefficient
+                self._flux = (self._image) * self.energy_intensity_coefficient * self.clip_coe *\
+                    self.leak_coe/self.pixel_size**2
+                dy, dx = self.hot_spot_finder.kernel.shape
+                # with ROI tracking, the hot spot is only searched around the beam
+                rows, columns = self.roi_slices()
+                if self._flux[rows, columns].shape[0] < dy or self._flux[rows, columns].shape[1] < dx:
+                    rows, columns = slice(0, None), slice(0, None)
+                self._hot_spot, (cy, cx) = self.hot_spot_finder.find(
+                    self._flux[rows, columns])
+                cy, cx = cy + rows.start, cx + columns.start
+                min_value = np.min(self._flux)
+                enlarged_length = 4
+                draw_rectangle(self._flux, (max(0, int(cx-(dx+1+enlarged_length)/2)), max(int(cy-(dy+1+enlarged_length)/2), 0)), (min(int(cx+(dx+1+enlarged_length)/2),
+                               self._flux.shape[1]),  min(int(cy+(dy+1+enlarged_length)/2), self._flux.shape[0])), min_value, width=3)
+        if self._has_MeV_mark:
+            with timer.measure('overlay'):
+                # the overlay is rendered once per image geometry and reused for every frame
+                self._image_with_MeV_mark = self.MeV_mark_overlay.apply(
+                    self._image)
+        if self._debug:
             self.logger.info(
-                f"Image is save to {path_to_name}")
-            self.save_settings(path, data_to_log)
-            if self._calibration:
-                os.makedirs(os.path.join(
-                    path, self.flux_path_string), exist_ok=True)
-                parts = path_to_name.split(os.sep)
-                parts.insert(-1, self.flux_path_string)
-                flux_to_save.save(os.path.join(*parts))
-                self.logger.info(
-                    f"{self.flux_path_string} is save to {path_to_name}")
+                f"{self._image_number} new. mean intensity: {np.mean(self._image)}")
 
-                # flux_path_string = "smoothed_flux_image"
-                # os.makedirs(os.path.join(
-                #     path, flux_path_string), exist_ok=True)
-                # parts = path_to_name.split(os.sep)
-                # parts.insert(-1, flux_path_string)
-                # q.get().save(os.path.join(*parts))
-                # self.logger.info(
-                #     f"f{flux_path_string} is save to {path_to_name}")
+    def publish_frame(self):
+        super().publish_frame()
+        if self._has_MeV_mark:
+            self.push_change_event(
+                "image_with_MeV_mark", self.read_image_with_MeV_mark("placeholder"))
+        self.push_change_event("flux", self.read_flux())
+        self.push_change_event(
+            "energy", self.read_energy())
+        self.push_change_event(
+            "hot_spot", self.read_hot_spot())
+
+    def naming_fields(self):
+        return {'%s': f'ImageNum{self._image_number}', '%t': f'Time{self._read_time}', '%e': f'Energy{self._energy:.3f}J', '%h': f'HotSpot{self._hot_spot:.4f}Jcm-2', '%f': 'tiff'}
+
+    def frame_flux(self):
+        return self._flux if self._calibration else None
 
     def read_image(self):
         # now read_image() is only triggered when it is a new image. Polling period setting in attribute will Not overwrite the polling settings in the db.
         # If image is polling automatically (periodically), push event from server side still work. But the client request from client side will use the data stored in the period polled buffer.
         # If image is not polling automatically, the client request will call the read_attr function and thus use the latest data.
         # Therefore, image should not be polled.
-        self.logger.info(f'in server read: {np.mean(self._image)}')
+        if self._debug:
+            self.logger.info(f'in server read: image {self._image_number}')
         return self._image
 
     def read_image_r(self):
@@ -1187,19 +1126,6 @@ class Basler(Device):
     def read_hot_spot(self):
         return self._hot_spot
 
-    def disable_polling(self, attr):
-        if self.is_attribute_polled(attr):
-            self.stop_poll_attribute(attr)
-            self.logger.info(f'polling for {attr} is disabled')
-
-    def enable_polling(self, attr):
-        if not self.is_attribute_polled(attr):
-            if not self._polling:
-                self._polling = 200
-            self.poll_attribute(attr, self._polling)
-            self.logger.info(
-                f'polling period of {attr} is set to {self._polling}')
-
     @command()
     def get_ready(self):
         """
@@ -1239,13 +1165,30 @@ class Basler(Device):
     @command()
     def relax(self):
         self.camera.StopGrabbing()
+        self.frame_buffer.clear()
         self.logger.info("Grabbing stops")
 
     @command(dtype_in=int)
     def reset_number(self, number=0):
         self._image_number = number
+        self._grabbed_number = number
+        self.frame_buffer.reset_counters()
         self.logger.info("Reset image number")
 
+    @command(dtype_out=str)
+    def dump_stage_latency(self):
+        """
+        Log and return the latency table of the frame pipeline stages.
+        """
+        summary = self.stage_timer.summary()
+        self.logger.info(f'stage latency\n{summary}')
+        return summary
+
+    @command()
+    def reset_stage_latency(self):
+        self.stage_timer.reset()
+        self.logger.info("Reset stage latency")
+
 
 if __name__ == "__main__":
     Basler.run_server()
@@ -24,6 +24,14 @@ logging.basicConfig(
 
 
 class Daq:
+    # wait for the events of the cameras announcing a new frame instead of polling is_new_image. Cameras whose server cannot send the events are polled.
+    use_events = True
+    # (first, longest) delay in seconds between two reads of is_new_image of a polled camera without a new frame. The delay doubles after each empty read.
+    poll_delay = (0.01, 0.2)
+    # placeholders of the file name and the attributes they need
+    naming_attributes = {'%t': 'read_time', '%e': 'energy',
+                         '%h': 'hot_spot', '%o': 'current_file'}
+
     def __init__(self, select_cam_list, dir='', debug=False, GUI=None):
         if GUI is None:
             self.logger = logging.getLogger(__name__).info
@@ -161,17 +169,50 @@ class Daq:
                 with open(os.path.join(p, "settings.json"), "a+") as settings_File:
                     settings_File.write(json_object + "\n")
 
-    def get_image(self, bs):
-        bits = ''.join([i for i in bs.format_pixel if i.isdigit()])
-        if getattr(bs, 'format_pixel', '').lower() == "rgb8":
-            image = np.dstack((bs.image_r, bs.image_g, bs.image_b))
+    def fetch_plan(self, info):
+        '''decide once per acquisition which attributes are read for every shot of the device, so that a shot costs a single read_attributes call.'''
+        bs = info['device_proxy']
+        dev_class = bs.info().dev_class.lower()
+        attributes = bs.get_attribute_list()
+        kind = 'xy' if dev_class == 'filereader' and bs.data_type == "xy" else 'image'
+        names = [attr for placeholder, attr in self.naming_attributes.items()
+                 if placeholder in info['file_name'] and attr in attributes]
+        if kind == 'image':
+            names.append('format_pixel')
+            if 'image_r' in attributes and bs.format_pixel.lower() == "rgb8":
+                names += ['image_r', 'image_g', 'image_b']
+            else:
+                names.append('image')
+            if 'image_with_MeV_mark' in attributes:
+                names.append('image_with_MeV_mark')
         else:
-            image = bs.image
+            names += ['folder_path', 'current_file', 'files_per_shot']
+        # the frame counter is read with the frame to check that it is the next one
+        counter = 'file_number' if dev_class == 'filereader' else 'image_number'
+        queued = 'files_pending' if dev_class == 'filereader' else 'frames_queued'
+        return {'kind': kind, 'counter': counter, 'queued': queued, 'attributes': list(dict.fromkeys([counter] + names))}
+
+    def fetch_shot(self, info, names):
+        '''values of the attributes names of the device, read in one call.'''
+        values = {}
+        for name, attr in zip(names, info['device_proxy'].read_attributes(names)):
+            if attr.has_failed:
+                raise tango.DevFailed(*attr.get_err_stack())
+            values[name] = attr.value
+        return values
+
+    def get_image(self, values):
+        bits = ''.join([i for i in values['format_pixel'] if i.isdigit()])
+        if values['format_pixel'].lower() == "rgb8" and 'image_r' in values:
+            image = np.dstack(
+                (values['image_r'], values['image_g'], values['image_b']))
+        else:
+            image = values['image']
         if int(bits) > 8:
             bits = '16'
         data_PIL = Image.fromarray(image.astype(f'uint{bits}'))
-        if hasattr(bs, "image_with_MeV_mark"):
-            data_array = bs.image_with_MeV_mark.astype(f'uint{bits}')
+        if 'image_with_MeV_mark' in values:
+            data_array = values['image_with_MeV_mark'].astype(f'uint{bits}')
         else:
             data_array = image.astype(f'uint{bits}')
         return data_PIL, data_array
@@ -273,9 +314,95 @@ class Daq:
                 except Exception as e:
                     self.logger(f"Error copying file: {e}", 'red_text')
 
+    def claim_frames(self, info):
+        '''make the DAQ the only reader of the frames of the device, so that the attributes read after a True is_new_image belong to that frame. A FileReader that parses files on arrival publishes them on its own. Return the settings to restore after the acquisition.'''
+        bs = info['device_proxy']
+        restore = {}
+        if 'parse_on_arrival' in bs.get_attribute_list() and bs.parse_on_arrival:
+            bs.parse_on_arrival = False
+            restore['parse_on_arrival'] = True
+        return restore
+
+    def subscribe_frames(self, info):
+        '''subscribe to the change events of the number of frames waiting in the device (frames_queued, or files_pending for a FileReader), which the server pushes when a frame arrives. Return the queue receiving the events, or None if the device has to be polled.'''
+        bs = info['device_proxy']
+        events = queue.Queue()
+
+        def push_arrival(event):
+            if event.err:
+                self.logger(
+                    f"Event error from {info['user_defined_name']}: {event.errors[0].desc if event.errors else ''}", 'red_text')
+            else:
+                events.put(event.attr_value.value)
+        try:
+            info['event_id'] = bs.subscribe_event(
+                info['fetch_plan']['queued'], tango.EventType.CHANGE_EVENT, push_arrival)
+            # read at once, frames may have arrived before the subscription
+            info['next_read_in'] = 0
+            return events
+        except Exception as e:
+            self.logger(
+                f"{info['user_defined_name']} does not send frame events and is polled instead. Details: {e}", 'red_text')
+            return None
+
+    def next_shot(self, info, events):
+        '''values of the attributes in the fetch plan for the next frame of the device, or None if there is no new frame.
+
+        The device only processes a frame when is_new_image is read, and keeps its data until the next read. With events, the DAQ waits for a frame to arrive and reads is_new_image, the number of waiting frames and the data in one read_attributes call. The attributes are read in order, so the data belongs to the frame processed by that read. While frames are waiting, the device is read again without waiting for an event, after a short delay if the frame was not ready (e.g. a file still being written). Without events, is_new_image is polled with a growing delay while there is no new frame, and the data is read after it.
+        '''
+        bs = info['device_proxy']
+        plan = info['fetch_plan']
+        if events is None:
+            if not bs.is_new_image:
+                delay = info.get('poll_delay', self.poll_delay[0])
+                time.sleep(delay)
+                info['poll_delay'] = min(2 * delay, self.poll_delay[1])
+                return None
+            info['poll_delay'] = self.poll_delay[0]
+            values = self.fetch_shot(info, plan['attributes'])
+        else:
+            wait = info['next_read_in']
+            try:
+                if wait is None:
+                    events.get(timeout=0.5)
+                elif wait:
+                    events.get(timeout=wait)
+            except queue.Empty:
+                if wait is None:
+                    return None
+            # the frames announced so far are counted by this read
+            while not events.empty():
+                events.get_nowait()
+            values = self.fetch_shot(
+                info, ['is_new_image', plan['queued']] + plan['attributes'])
+            if not values[plan['queued']]:
+                info['next_read_in'] = None
+            else:
+                info['next_read_in'] = 0 if values['is_new_image'] else 0.05
+            if not values['is_new_image']:
+                return None
+        return values if self.is_next_frame(info, values[plan['counter']]) else None
+
+    def is_next_frame(self, info, counter):
+        '''check the frame counter read with the frame. A counter that did not increase is a frame that was already saved, e.g. read from the polling cache, and it is dropped. A jump means that frames were taken by another client and are missing.'''
+        if counter <= info['frame_counter']:
+            return False
+        if counter > info['frame_counter'] + 1:
+            self.logger(
+                f"{info['user_defined_name']} processed {counter - info['frame_counter'] - 1} frames that were not saved.", 'red_text')
+        info['frame_counter'] = counter
+        return True
+
     def thread_acquire_data(self, info, stitch, shot_end,):
+        events = None
+        restore = {}
         try:
             xy_reader_count = 0
+            plan = info['fetch_plan'] = self.fetch_plan(info)
+            restore = self.claim_frames(info)
+            info['frame_counter'] = getattr(
+                info['device_proxy'], plan['counter'])
+            events = self.subscribe_frames(info) if self.use_events else None
             while True:
                 if self.thread_event is not None and self.thread_event.is_set():
                     # self.logger(
@@ -286,7 +413,11 @@ class Daq:
                 t0 = datetime.now()
                 if info['shot_num'] > shot_end:
                     info['is_completed'] = True
-                elif bs.is_new_image:
+                    if events is not None:
+                        time.sleep(0.5)
+                    continue
+                values = self.next_shot(info, events)
+                if values is not None:
                     if self.GUI.options["use_plasma_mirror"]:
                         try:
                             self.plasma_mirror_stages = tango.DeviceProxy(
@@ -300,9 +431,9 @@ class Daq:
                         except Exception as e:
                             self.logger(
                                 f'Error in accessing plasma mirror stage: {e}', 'red_text')
-                    if (bs.info().dev_class.lower() in ['basler', 'vimba']) or (bs.info().dev_class.lower() == 'filereader' and bs.data_type == "image"):
-                        data, data_array = self.get_image(bs)
-                        file_name = self.generate_file_name(info, bs)
+                    if plan['kind'] == 'image':
+                        data, data_array = self.get_image(values)
+                        file_name = self.generate_file_name(info, values)
                         file_name = file_name.replace('%f', 'tiff')
                         # self.logger(
                         #     f"It takes {datetime.now()-t0} to acquire {info['user_defined_name']} {info['shot_num']}.")
@@ -313,19 +444,20 @@ class Daq:
                         add_number = 1
                         # For scope, it saves multiple files per shot. stitch_local set to True only every bs.files_per_shot.
                         stitch_local = True
-                    elif bs.info().dev_class.lower() == 'filereader' and bs.data_type == "xy":
-                        file_name = self.generate_file_name(info, bs)
+                    elif plan['kind'] == 'xy':
+                        file_name = self.generate_file_name(info, values)
                         file_name = file_name.replace('%f', 'csv')
                         source_path = os.path.join(
-                            bs.folder_path, bs.current_file)
+                            values['folder_path'], values['current_file'])
                         destination_path = os.path.join(
                             info['cam_dir'], file_name)
                         message = f"Shot {info['shot_num']} for {info['user_defined_name']} is saved."
                         info["saving_queue"].put(
                             ("copy_file", source_path, destination_path, message))
                         xy_reader_count += 1
-                        if xy_reader_count == bs.files_per_shot:
-                            data_array = self.save_plot_data(bs.x, bs.y)
+                        if xy_reader_count == values['files_per_shot']:
+                            x, y = (attr.value for attr in bs.read_attributes(['x', 'y']))
+                            data_array = self.save_plot_data(x, y)
                             add_number = 1
                             xy_reader_count = 0
                             stitch_local = True
@@ -333,7 +465,7 @@ class Daq:
                             add_number = 0
                             stitch_local = False
                     if stitch and stitch_local:
-                        if getattr(bs, 'format_pixel', '').lower() == "rgb8":
+                        if values.get('format_pixel', '').lower() == "rgb8":
                             data_array = 0.299 * \
                                 data_array[:, :, 0] + 0.587 * data_array[:,
                                                                          :, 1] + 0.114 * data_array[:, :, 2]
@@ -344,6 +476,18 @@ class Daq:
         except Exception as e:
             self.logger(
                 f'Error in {info["user_defined_name"]} "thread_acquire_data" thread: {e}', 'red_text')
+        finally:
+            if events is not None:
+                try:
+                    info['device_proxy'].unsubscribe_event(info['event_id'])
+                except Exception:
+                    pass
+            for key, value in restore.items():
+                try:
+                    setattr(info['device_proxy'], key, value)
+                except Exception as e:
+                    self.logger(
+                        f"Failed to restore {info['user_defined_name']}/{key} to {value}. Details: {e}", 'red_text')
 
     def thread_stitch_images(self):
         try:
@@ -440,7 +584,8 @@ class Daq:
                 return
             time.sleep(0.3)
 
-    def generate_file_name(self, info, bs, shoot=True):
+    def generate_file_name(self, info, values, shoot=True):
+        '''file name of the shot from the naming format of the camera. values are the attributes read for the shot.'''
         rep = info['file_name']
         if '%s' in rep:
             if not shoot:
@@ -448,15 +593,15 @@ class Daq:
             else:
                 rep = rep.replace('%s', f'Shot{info["shot_num"]}')
         if '%t' in rep:
-            rep = rep.replace('%t', f'Time{bs.read_time}')
+            rep = rep.replace('%t', f'Time{values["read_time"]}')
         if '%e' in rep:
-            rep = rep.replace('%e', f'Energy{bs.energy:.3f}J')
+            rep = rep.replace('%e', f'Energy{values["energy"]:.3f}J')
         if '%h' in rep:
-            rep = rep.replace('%h', f'HotSpot{bs.hot_spot:.4f}Jcm-2')
+            rep = rep.replace('%h', f'HotSpot{values["hot_spot"]:.4f}Jcm-2')
         # if '%id' in rep:
         #     rep = rep.replace('%id', f'id{self.labview.shot_id}')
         if '%o' in rep:
-            rep = rep.replace('%o', f'{bs.current_file}')
+            rep = rep.replace('%o', f'{values["current_file"]}')
         return rep
 
     def set_scan_value(self, attr_proxy, value_list: list, shot_number: int):
@@ -1,11 +1,8 @@
 import queue
 from watchfiles import watch
 import threading
-import sif_parser
 import platform
-import csv
 import os
-from PIL import Image
 import logging
 import datetime
 import time
@@ -13,7 +10,13 @@ import numpy as np
 from tango.server import Device, attribute, command, device_property
 from tango import AttrWriteType, DevState, DevFloat, EncodedAttribute
 from common.logger_adapter import LoggerAdapter
-from common.shared_server_side import add_center_of_mass_functions
+from common.camera_pipeline import CameraPipeline
+from common.file_completion import FileCompletion
+from common.xy_parser import read_xy
+from common.folder_index import FolderIndex
+from common.decode_pool import DecodePool, decode_image_file
+from common.raw_image import parse_raw_format
+from common.shared_server_side import add_center_of_mass_functions, add_stage_timing_functions
 
 # -----------------------------
 
@@ -23,10 +26,13 @@ logging.basicConfig(handlers=handlers,
 
 
 @add_center_of_mass_functions
-class FileReader(Device):
+@add_stage_timing_functions
+class FileReader(CameraPipeline, Device):
     # file_type can be 'image' or 'xy'. If it is 'image', then the device will read image files. If it is 'xy', then the device will read xy data files.
     file_type = device_property(dtype=str, default_value='image')
     extra_script = device_property(dtype=str, default_value='center_of_mass')
+    frame_counter = '_file_number'
+    queue_attribute = 'files_pending'
 
     host_computer = attribute(
         label="host computer",
@@ -106,13 +112,13 @@ class FileReader(Device):
     )
 
     def read_polling_period(self):
-        self._polling_period = self.get_attribute_poll_period('is_new_image')
-        return self._polling_period
+        self._polling = self.get_attribute_poll_period('is_new_image')
+        return self._polling
 
     def write_polling_period(self, value):
         if value > 5:
             self.poll_attribute('is_new_image', value)
-            self._polling_period = value
+            self._polling = value
 
     file_extension = attribute(
         label="file extension",
@@ -153,19 +159,48 @@ class FileReader(Device):
         # stop_event automatically stops this generator when set()
         for changes in watch(self._folder_path, recursive=False, stop_event=self.stop_event):
             for change_type, file_path in changes:
-                if change_type.name == 'added' and file_path.endswith(tuple(self._file_extension.split(','))) and os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
+                # files are often created empty and then written. FileCompletion waits until they are complete.
+                if change_type.name == 'added' and file_path.endswith(tuple(self._file_extension.split(','))) and os.path.isfile(file_path):
                     logging.info(
                         f"New file found in {self._folder_path}: {file_path}")
-                    self.new_files_queue.put(file_path)
+                    self.folder_index.add(file_path)
+                    self.queue_file(file_path)
         logging.info(f"--- Stopped watching: {self._folder_path} ---")
 
+    def queue_file(self, path):
+        self.new_files_queue.put(path)
+        self.file_arrived.set()
+        self.announce_arrival()
+
     def start_watching(self):
         self.stop_event.clear()
-        self.new_files_queue.queue.clear()
+        self.drop_queued_files()
+        self.index_folder()
         self.monitor_thread = threading.Thread(
             target=self._watch_loop, daemon=True)
         self.monitor_thread.start()
 
+    def drop_queued_files(self):
+        '''forget the queued files, including the one held back and the ones in the decode pool, so that none of them is published. The decode pool is started again for the next file.'''
+        with self._parse_lock:
+            self.new_files_queue.queue.clear()
+            self._held_file = None
+            if self.decode_pool is not None:
+                dropped = self.decode_pool.close()
+                self.decode_pool = None
+                if dropped:
+                    self.logger.info(
+                        f"{len(dropped)} files in the decode pool are dropped, from {os.path.basename(dropped[0])}.")
+            self.file_completion.forget()
+
+    def index_folder(self):
+        '''load the index of the watched folder and add the files written while nobody was watching. They are not read automatically, since every read file counts as a shot for the DAQ. Use replay to read them.'''
+        self.folder_index = FolderIndex(self._folder_path, self._file_extension.split(','), self.logger)
+        new = self.folder_index.scan()
+        if new:
+            self.logger.info(
+                f"{len(new)} files in {self._folder_path} were not indexed before: files {new[0]} to {new[-1]}.")
+
     def change_watching_folder_and_extension(self):
         logging.info("Changing folder or extension...")
         self.stop_event.set()  # Signals watch() to stop
@@ -216,87 +251,254 @@ class FileReader(Device):
         access=AttrWriteType.READ,
     )
 
+    parse_on_arrival = attribute(
+        label="parse on arrival",
+        dtype=bool,
+        memorized=True,
+        hw_memorized=True,
+        access=AttrWriteType.READ_WRITE,
+        doc='If True, a worker thread parses every file as soon as it arrives and pushes the change events of image (or x and y), current_file, read_time and file_number. Subscribe to these events to get every file. is_new_image is then True once if files were parsed since the last read, and the other attributes hold the newest file, so a client reading them can miss files of a burst. If False (default), one file is parsed per read of is_new_image and the attributes hold that file until the next read.'
+    )
+
+    def read_parse_on_arrival(self):
+        return self._parse_on_arrival
+
+    def write_parse_on_arrival(self, value):
+        if value and not self._parse_on_arrival:
+            # files reported by is_new_image so far are not reported again
+            self._files_reported = self._files_published
+        self._parse_on_arrival = value
+        self.file_arrived.set()
+
+    files_pending = attribute(
+        label="files pending",
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc="files found in the folder and not parsed yet"
+    )
+
+    def read_files_pending(self):
+        in_flight = self.decode_pool.in_flight if self.decode_pool is not None else 0
+        return self.new_files_queue.qsize() + (self._held_file is not None) + in_flight
+
+    completion_window = attribute(
+        label="completion window",
+        dtype=float,
+        unit='ms',
+        memorized=True,
+        hw_memorized=True,
+        access=AttrWriteType.READ_WRITE,
+        doc='a new file is read once its size and modification time have not changed for this long'
+    )
+
+    def read_completion_window(self):
+        return self.file_completion.window * 1000
+
+    def write_completion_window(self, value):
+        self.file_completion.window = max(value, 0) / 1000
+
+    parse_attempts = attribute(
+        label="parse attempts",
+        dtype=int,
+        memorized=True,
+        hw_memorized=True,
+        access=AttrWriteType.READ_WRITE,
+        doc='number of times a complete file is parsed before it is skipped and counted in files_failed'
+    )
+
+    def read_parse_attempts(self):
+        return self.file_completion.attempts
+
+    def write_parse_attempts(self, value):
+        self.file_completion.attempts = max(value, 1)
+
+    files_failed = attribute(
+        label="files failed",
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc="files skipped because they could not be parsed"
+    )
+
+    def read_files_failed(self):
+        return self._files_failed
+
+    last_failure = attribute(
+        label="last failure",
+        dtype=str,
+        access=AttrWriteType.READ,
+        doc="name of the last skipped file and the error"
+    )
+
+    def read_last_failure(self):
+        return self._last_failure
+
+    indexed_files = attribute(
+        label="indexed files",
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc="number of files in the index of the watched folder. Files are numbered from 0 in the order they were written."
+    )
+
+    def read_indexed_files(self):
+        return len(self.folder_index)
+
     def read_is_new_image(self):
+        if self._parse_on_arrival:
+            # the attributes hold the newest file, so several parsed files are reported once
+            if self._files_reported < self._files_published:
+                self._files_reported = self._files_published
+                return True
+            return False
+        return self.process_next_file()
+
+    def _parse_loop(self):
+        while not self.parse_stop_event.is_set():
+            self.file_arrived.wait(timeout=1)
+            self.file_arrived.clear()
+            try:
+                while self._parse_on_arrival and not self.parse_stop_event.is_set() and self.process_next_file():
+                    pass
+            except Exception as e:
+                self.logger.error(f"Error in parsing {self._current_file}: {e}")
+
+    def process_next_file(self):
+        '''parse the next file of the queue and push its data. Return False if there is no new file.'''
+        with self._parse_lock:
+            if self.file_type == "image":
+                published = self.process_next_frame()
+            else:
+                published = self.process_next_xy()
+            if published:
+                self._files_published += 1
+            return published
+
+    def next_file(self):
+        '''path of the next file to parse, or None if the queue is empty.'''
+        if self._held_file is not None:
+            path, self._held_file = self._held_file, None
+            return path
         try:
-            new_file = self.new_files_queue.get(block=False)
+            return self.new_files_queue.get(block=False)
         except queue.Empty:
-            new_file = None
-
-        if new_file:
-            self._current_file = new_file.split(os.sep)[-1]
-            while True:
-                try:
-                    if self.file_type == "image":
-                        if self._current_file.endswith('.sif'):
-                            # read file
-                            self._image, info = sif_parser.np_open(
-                                os.path.join(self._folder_path, self._current_file))
-                            self._image = np.squeeze(self._image)
-                            self._format_pixel = '16'
-                        else:
-                            image_PIL = Image.open(
-                                os.path.join(self._folder_path, self._current_file))
-                            self._image = np.array(image_PIL)
-                            self._format_pixel = str(
-                                self.mode_to_bpp[image_PIL.mode])
-                        self.calculate_center_of_mass()
-                        self.push_change_event(
-                            "image", self.read_image("placeholder"))
-                    elif self._data_structure == 0:
-                        with open(os.path.join(self._folder_path, self._current_file), newline='') as csvfile:
-                            reader = csv.reader(csvfile)
-                            self._x, self._y = [], []
-                            start = False
-                            stop = False
-                            for row in reader:
-                                if row[0] == '[EndOfFile]':
-                                    stop = True
-                                if start and not stop:
-                                    # if the delimiter is not the default ',', then the row has only one element and I need to split the row manually.
-                                    if len(row) == 1:
-                                        if not hasattr(self, 'delimiter'):
-                                            potential_delimiters = [';', ' ']
-                                            for d in potential_delimiters:
-                                                if d in row[0]:
-                                                    self.delimiter = d
-                                        self._x.append(
-                                            float(row[0].split(self.delimiter)[0]))
-                                        self._y.append(
-                                            float(row[0].split(self.delimiter)[-1]))
-                                    else:
-                                        self._x.append(float(row[0]))
-                                        self._y.append(float(row[1]))
-                                if row[0] == '[Data]':
-                                    start = True
-                    elif self._data_structure == 1 and self._substring_of_display_channel in self._current_file:
-                        with open(os.path.join(self._folder_path, self._current_file), newline='') as csvfile:
-                            reader = csv.reader(csvfile)
-                            self._x, self._y = [], []
-                            for idx, row in enumerate(reader):
-                                if idx > 5:
-                                    self._x.append(float(row[0]))
-                                    self._y.append(float(row[1]))
-                    break
-                except PermissionError:
-                    if os.path.isfile(os.path.join(self._folder_path, self._current_file)):
-                        self.logger.info(
-                            f"We encounterred an PermissionError reading {os.path.join(self._folder_path, self._current_file)}. However, this could be the new file was building.")
-                    self.logger.info("Will try in 0.5 second.")
-                    time.sleep(0.5)
-                except Exception:
-                    self.logger.info("Will try in 0.5 second.")
-                    time.sleep(0.5)
-            self._read_time = datetime.datetime.fromtimestamp(os.path.getmtime(
-                os.path.join(self._folder_path, self._current_file))).strftime("%H-%M-%S.%f")
-            self._file_number += 1
-            self.push_change_event("current_file", self.read_current_file())
-            self.push_change_event("read_time",
-                                   self.read_read_time())
-            self.push_change_event("file_number",
-                                   self.read_file_number())
-            return True
-        else:
+            return None
+
+    def may_block(self):
+        '''only the parse worker waits for files. A read of is_new_image runs on a Tango request thread and returns at once.'''
+        return threading.current_thread() is self.parse_thread
+
+    def next_complete_file(self, parse):
+        '''take files from the queue until one is complete and parsed. Return (path, parse(path)), or (None, None) if the queue is empty or, on a request thread, if the next file is not complete yet. That file is kept and looked at again on the next read. A file that fails all attempts is skipped and reported in files_failed and last_failure.'''
+        while True:
+            path = self.next_file()
+            if path is None:
+                return None, None
+            try:
+                with self.stage_timer.measure('retrieve'):
+                    if self.may_block():
+                        return path, self.file_completion.read(path, parse, self.parse_stop_event)
+                    is_read, data = self.file_completion.poll(path, parse)
+                if is_read:
+                    return path, data
+                self._held_file = path
+                return None, None
+            except Exception as e:
+                self.report_failed_file(path, e)
+
+    def report_failed_file(self, path, error):
+        self._files_failed += 1
+        self._last_failure = f"{os.path.basename(path)}: {error}"
+        self.logger.error(f"Skipping {path}: {error}")
+        self.push_change_event("files_failed", self._files_failed)
+        self.push_change_event("last_failure", self._last_failure)
+
+    def process_next_xy(self):
+        path, xy = self.next_complete_file(self.read_xy_file)
+        if path is None:
             return False
+        self._current_file = os.path.basename(path)
+        if xy is not None:
+            self._x, self._y = xy
+            self.folder_index.add(path, self._x.shape)
+        self._read_time = datetime.datetime.fromtimestamp(
+            os.path.getmtime(path)).strftime("%H-%M-%S.%f")
+        self._file_number += 1
+        self.push_change_event("x", self.read_x("placeholder"))
+        self.push_change_event("y", self.read_y("placeholder"))
+        self.publish_file_info()
+        self.announce_frame()
+        return True
+
+    def read_xy_file(self, path):
+        '''return (x, y) of a VISSpec (data structure 0) or Lecroy (data structure 1) csv file, or None if the file is not the displayed channel.'''
+        if self._data_structure == 0 or (self._data_structure == 1 and self._substring_of_display_channel in os.path.basename(path)):
+            return read_xy(path, self._data_structure)
+        return None
+
+    def acquire_frame(self):
+        self.update_decode_pool()
+        if self.decode_pool is None:
+            path, image = self.next_complete_file(self.read_image_file)
+        else:
+            path, image = self.next_decoded_image()
+        if path is None:
+            return None, None
+        self._current_file = os.path.basename(path)
+        self._read_time = datetime.datetime.fromtimestamp(
+            os.path.getmtime(path)).strftime("%H-%M-%S.%f")
+        self._file_number += 1
+        self.folder_index.add(path, image.shape)
+        return image, time.monotonic()
+
+    def read_image_file(self, path):
+        image, self._format_pixel = decode_image_file(path, self._raw_format)
+        return image
+
+    def next_decoded_image(self):
+        '''same as next_complete_file(self.read_image_file), with the files decoded by the process pool. The following files are submitted before this one is returned, so they are decoded while it is processed and published.'''
+        while True:
+            self.fill_decode_pool()
+            if self.decode_pool.in_flight == 0 or not (self.may_block() or self.decode_pool.ready()):
+                return None, None
+            with self.stage_timer.measure('retrieve'):
+                path, image, pixel_format, error = self.decode_pool.result()
+            self.fill_decode_pool()
+            if error is None:
+                self._format_pixel = pixel_format
+                return path, image
+            self.report_failed_file(path, error)
+
+    def fill_decode_pool(self):
+        while not self.decode_pool.full():
+            path = self.next_file()
+            if path is None:
+                return
+            self.decode_pool.submit(path, self._raw_format)
+
+    def update_decode_pool(self):
+        '''apply a change of decode_workers once no file is in flight.'''
+        if self.decode_pool is not None and (self.decode_pool.in_flight or self.decode_pool.workers == self._decode_workers):
+            return
+        if self.decode_pool is not None:
+            self.decode_pool.close()
+            self.decode_pool = None
+        if self._decode_workers > 0:
+            self.decode_pool = DecodePool(
+                self._decode_workers, self.file_completion)
+
+    def publish_frame(self):
+        super().publish_frame()
+        self.publish_file_info()
+
+    def publish_file_info(self):
+        self.push_change_event("current_file", self.read_current_file())
+        self.push_change_event("read_time",
+                               self.read_read_time())
+
+    def naming_fields(self):
+        return {'%s': f'FileNum{self._file_number}', '%t': f'Time{self._read_time}', '%o': os.path.splitext(self._current_file)[0], '%f': 'tiff'}
+
+    def frame_settings(self):
+        return {'_read_time': str(self._read_time), '_file_number': str(self._file_number), '_current_file': self._current_file}
 
     format_pixel = attribute(
         label="pixel format",
@@ -367,18 +569,73 @@ class FileReader(Device):
             doc="substring in the name of the file that needs to be displayed"
         )
 
+        decode_workers = attribute(
+            name="decode_workers",
+            label="decode workers",
+            dtype=int,
+            memorized=True,
+            hw_memorized=True,
+            access=AttrWriteType.READ_WRITE,
+            doc="number of processes decoding image files. Up to twice as many files are decoded ahead. 0 decodes in the parse thread."
+        )
+
+        decode_in_flight = attribute(
+            name="decode_in_flight",
+            label="decoding",
+            dtype=int,
+            access=AttrWriteType.READ,
+            doc="files submitted to the decode workers and not processed yet"
+        )
+
+        raw_format = attribute(
+            name="raw_format",
+            label="raw format",
+            dtype=str,
+            memorized=True,
+            hw_memorized=True,
+            access=AttrWriteType.READ_WRITE,
+            doc='layout of headerless .raw and .bin files as "dtype,height,width[,header bytes]", e.g. "uint16,2048,2048". Uncompressed TIFF files are read directly without it.'
+        )
+
         if self.file_type == 'image':
             self.add_attribute(image)
+            self.add_attribute(raw_format)
+            self.add_attribute(decode_workers)
+            self.add_attribute(decode_in_flight)
+            self.set_change_event('image', True, False)
             if self.extra_script == 'center_of_mass':
                 self.initialize_center_of_mass_attributes()
+            self.initialize_saving_attributes()
+            self.initialize_stage_timing_attributes()
         elif self.file_type == 'xy':
             self.add_attribute(x)
             self.add_attribute(y)
             self.add_attribute(files_per_shot)
             self.add_attribute(substring_of_display_channel)
+            self.set_change_event('x', True, False)
+            self.set_change_event('y', True, False)
             self._files_per_shot = 1
             self._substring_of_display_channel = "C1"
 
+    def read_raw_format(self, attr):
+        return self._raw_format
+
+    def write_raw_format(self, attr):
+        value = attr.get_write_value()
+        if value:
+            parse_raw_format(value)
+        self._raw_format = value
+
+    def read_decode_workers(self, attr):
+        return self._decode_workers
+
+    def write_decode_workers(self, attr):
+        self._decode_workers = max(attr.get_write_value(), 0)
+        self.file_arrived.set()
+
+    def read_decode_in_flight(self, attr):
+        return self.decode_pool.in_flight if self.decode_pool is not None else 0
+
     def read_files_per_shot(self, attr):
         return self._files_per_shot
 
@@ -394,55 +651,106 @@ class FileReader(Device):
     def init_device(self):
         self._host_computer = platform.node()
 
+        self.init_pipeline()
         super().init_device()
         self._user_defined_name = ''
         self.logger_base = logging.getLogger(self.__class__.__name__)
         self.logger = LoggerAdapter(self._user_defined_name, self.logger_base)
+        self.start_saving()
         self._data_structure = 0
         self._debug = False
         self._is_polling_periodically = False
-        self._polling_period = 199
+        self._polling = 199
         self._folder_path = ''
         self._file_extension = 'tiff'
         self._current_file = ''
         self._read_time = 'N/A'
         self._image = np.zeros([1000, 1000])
-        self._x, self._y = [], []
+        self._x, self._y = np.zeros(0), np.zeros(0)
         self._file_number = 0
         self._format_pixel = 'unknown'
-        self.mode_to_bpp = {"1": 1, "L": 8, "P": 8, "RGB": 24, "RGBA": 32, "CMYK": 32, "YCbCr": 24, "LAB": 24, "HSV": 24, "I": 32, "F": 32, "I;16": 16,
-                            "I;16B": 16, "I;16L": 16, "I;16S": 16, "I;16BS": 16, "I;16LS": 16, "I;32": 32, "I;32B": 32, "I;32L": 32, "I;32S": 32, "I;32BS": 32, "I;32LS": 32}
-        # self._polling_period = self.get_attribute_poll_period('is_new_image')
-        # if self._polling_period == 0:
-        #     self._polling_period = 200
+        # self._polling = self.get_attribute_poll_period('is_new_image')
+        # if self._polling == 0:
+        #     self._polling = 200
         self.new_files_queue = queue.Queue()
+        # file taken from the queue by a read of is_new_image that was not complete yet
+        self._held_file = None
         self.stop_event = threading.Event()
         self.monitor_thread = None
+        self.folder_index = FolderIndex('', ())
+        self._decode_workers = 2
+        self._raw_format = ''
+        self.decode_pool = None
+        self._parse_on_arrival = False
+        self._files_published = 0
+        self._files_reported = 0
+        self._parse_lock = threading.Lock()
+        self.file_arrived = threading.Event()
+        self.parse_stop_event = threading.Event()
+        self.file_completion = FileCompletion()
+        self._files_failed = 0
+        self._last_failure = ''
+        for name in ['current_file', 'read_time', 'files_failed', 'last_failure']:
+            self.set_change_event(name, True, False)
+        self.parse_thread = threading.Thread(
+            target=self._parse_loop, daemon=True)
+        self.parse_thread.start()
         logging.info(
             f'FileReader is started.')
         self.set_state(DevState.ON)
 
-    def disable_polling(self, attr):
-        if self.is_attribute_polled(attr):
-            self.stop_poll_attribute(attr)
-            logging.info(f'polling for {attr} is disabled')
-
-    def enable_polling(self, attr):
-        if not self.is_attribute_polled(attr):
-            if not self._polling_period:
-                self._polling_period = 200
-            self.poll_attribute(attr, self._polling_period)
-            logging.info(
-                f'polling period of {attr} is set to {self._polling_period}')
+    def delete_device(self):
+        self.stop_event.set()
+        self.parse_stop_event.set()
+        self.file_arrived.set()
+        # closing the pool first drops the files that are not decoded yet. The parse worker may still wait up to file_completion.timeout for the file being decoded, so it is not waited for that long.
+        if self.decode_pool is not None:
+            self.decode_pool.close()
+        self.parse_thread.join(timeout=2)
+        if self.parse_thread.is_alive():
+            self.logger.warning(
+                'The parse worker did not stop within 2 s.')
+        self.shutdown_pipeline()
+        super().delete_device()
 
     @command(dtype_in=int)
     def reset_number(self, number=0):
         self._file_number = number
         self.logger.info("Reset file number")
 
+    @command(dtype_in=(int,), dtype_out=int)
+    def replay(self, positions):
+        '''queue files [first, last] of the folder index, last included, and return how many were queued. Negative positions count from the newest file, e.g. [-3, -1] for the last three files.'''
+        if len(positions) != 2:
+            raise Exception('Give the first and the last file number.')
+        try:
+            names = self.folder_index.names(positions[0], positions[1])
+        except IndexError as e:
+            raise Exception(str(e))
+        for name in names:
+            self.queue_file(os.path.join(self._folder_path, name))
+        return len(names)
+
+    @command(dtype_in=int, dtype_out=str)
+    def fetch_file(self, position):
+        '''queue file N of the folder index (-1 for the newest) and return its name.'''
+        try:
+            name = self.folder_index.name(position)
+        except IndexError:
+            raise Exception(
+                f'There are {len(self.folder_index)} files in the index.')
+        self.queue_file(os.path.join(self._folder_path, name))
+        return name
+
+    @command(dtype_out=int)
+    def rescan_folder(self):
+        '''update the folder index from the folder and return the number of files that were not indexed.'''
+        return len(self.folder_index.scan())
+
     @command()
     def clear_queue(self):
-        self.new_files_queue.queue.clear()
+        self.drop_queued_files()
+        self._files_reported = self._files_published
 
 
 if __name__ == "__main__":
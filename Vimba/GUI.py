@@ -29,6 +29,9 @@ def create_app():
         else:
             pass_config1, pass_config2 = {}, {}
         vimba_app.add_device(d)
+        # with many cameras, show the decimated preview to reduce the network load
+        if len(args.device) > 3 and 'image' not in pass_config1 and 'preview' in vimba_app.attr_list[d]['attrs']:
+            pass_config1['image'] = 'preview'
 
         # image panel.
         image_panel, image_layout = vimba_app.create_blank_panel('v')
@@ -41,7 +44,7 @@ def create_app():
         form_panel, form_layout = vimba_app.create_blank_panel('v')
         vimba_app.gui.createPanel(form_panel, f'{d}_form')
         vimba_app.create_form_panel(form_layout,
-                                    d, exclude=['image', 'image_r', 'image_g', 'image_b', 'flux', 'energy', 'hot_spot'])
+                                    d, exclude=['image', 'image_r', 'image_g', 'image_b', 'flux', 'energy', 'hot_spot', 'preview'])
     if len(args.device) == 1 and args.device[0] in image_panel_config:
         pass_config2 = ({key: value for key, value in image_panel_config[args.device[0]].items(
         ) if key == "combine_form_with_onshot"})
@@ -2,13 +2,16 @@ from tango import AttrWriteType, DevState, DevFloat, EncodedAttribute
 from tango.server import Device, attribute, command, device_property
 import numpy as np
 import datetime
+import time
 import logging
 import sys
-from queue import Queue
 import platform
+from threading import Event
 from vmbpy import *
 from common.logger_adapter import LoggerAdapter
-from common.shared_server_side import add_center_of_mass_functions
+from common.frame_buffer import FrameRingBuffer
+from common.camera_pipeline import CameraPipeline
+from common.shared_server_side import add_center_of_mass_functions, add_preview_functions, add_stage_timing_functions
 # -----------------------------
 
 
@@ -16,7 +19,7 @@ def grabbing_wrap(func):
     def wrapper(*args, **kwargs):
         is_grabbing = args[0].camera.is_streaming()
         if is_grabbing:
-            args[0].camera.stop_streaming()
+            args[0].stop_streaming()
             args[0].logger.info(
                 f"stop grabbing temporarily in {func.__name__}")
         func(*args, **kwargs)
@@ -26,11 +29,12 @@ def grabbing_wrap(func):
 
 
 @add_center_of_mass_functions
-class Vimba(Device):
+@add_preview_functions
+@add_stage_timing_functions
+class Vimba(CameraPipeline, Device):
     '''
     is_polling_periodically attribute. If is_polling_periodically is False, the polling is manually controlled by the acquisition script, else the polling is made by the polling period "polling".
     '''
-
     image = attribute(
         label="image",
         max_dim_x=10000,
@@ -155,6 +159,72 @@ class Vimba(Device):
         if self._is_polling_periodically:
             self.poll_attribute('is_new_image', value)
 
+    frame_buffer_size = attribute(
+        label='frame buffer size',
+        dtype=int,
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='Number of preallocated frame slots between the frame callback and the image publishing in software and external trigger modes.'
+    )
+
+    def read_frame_buffer_size(self):
+        return self.frame_buffer.capacity
+
+    def write_frame_buffer_size(self, value):
+        if value < 1:
+            raise Exception('Must be at least 1.')
+        if value != self.frame_buffer.capacity:
+            self.frame_buffer.resize(value)
+
+    frame_buffer_policy = attribute(
+        label='frame buffer policy',
+        dtype=str,
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='What happens to a new frame when the frame buffer is full. "block" (default): hold the camera callback until a slot is free, so that no triggered frame is lost. "drop_oldest": overwrite the oldest waiting frame. "drop_newest": discard the new frame. Frames are numbered when they arrive, so dropped frames show up as gaps in image_number.'
+    )
+
+    def read_frame_buffer_policy(self):
+        return self.frame_buffer.policy
+
+    def write_frame_buffer_policy(self, value):
+        if value not in FrameRingBuffer.policies:
+            raise Exception(
+                f'Must be one of {", ".join(FrameRingBuffer.policies)}.')
+        self.frame_buffer.policy = value
+
+    frames_dropped = attribute(
+        label='frames dropped',
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc='Frames received from the camera but discarded because the frame buffer was full.'
+    )
+
+    def read_frames_dropped(self):
+        return self.frame_buffer.dropped
+
+    frames_queued = attribute(
+        label='frames queued',
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc='Frames waiting in the frame buffer.'
+    )
+
+    def read_frames_queued(self):
+        return self.frame_buffer.queued
+
+    frame_buffer_peak = attribute(
+        label='frame buffer peak',
+        dtype=int,
+        access=AttrWriteType.READ,
+        doc='Highest number of frames waiting in the frame buffer since the last reset_number.'
+    )
+
+    def read_frame_buffer_peak(self):
+        return self.frame_buffer.peak_occupancy
+
     image_number = attribute(
         label='image #',
         dtype=int,
@@ -203,6 +273,9 @@ class Vimba(Device):
         self.add_attribute(trigger_source)
         if self.extra_script == "center_of_mass":
             self.initialize_center_of_mass_attributes()
+        self.initialize_saving_attributes()
+        self.initialize_preview_attributes()
+        self.initialize_stage_timing_attributes()
 
     def read_exposure(self):
         self._exposure = self.camera.ExposureTimeAbs.get()
@@ -240,7 +313,9 @@ class Vimba(Device):
         self._host_computer = platform.node()
         self.read_trigger_source('args_holder')
         self._is_new_image = False
-        self.imageq = Queue()
+        if not hasattr(self, 'frame_buffer'):
+            self.frame_buffer = FrameRingBuffer(16, 'block')
+        self._streaming_stop = Event()
         self._image = np.zeros(
             (self.read_height('args_holder'), self.read_width('args_holder')))
         self.read_exposure()
@@ -252,11 +327,8 @@ class Vimba(Device):
         self.path_raw = ''
         self._is_polling_periodically = False
         self._debug = False
-        self._save_data = False
-        self._save_path = ''
-        self._naming_format = '%t.%f'
-        self._save_interval = 0
         self._image_number = 0
+        self._grabbed_number = 0
         self._read_time = 'N/A'
         self._use_date = False
         self._lr_flip = False
@@ -264,6 +336,7 @@ class Vimba(Device):
         self._rotate = 0
         self._frames_per_trigger = 1
         self._repetition = 50
+        self.init_pipeline()
         super().init_device()
         self.set_state(DevState.INIT)
         logger = logging.getLogger(self.__class__.__name__)
@@ -271,20 +344,12 @@ class Vimba(Device):
         handlers = [logging.StreamHandler()]
         logging.basicConfig(handlers=handlers,
                             format="%(asctime)s %(message)s", level=logging.INFO)
+        self.start_saving()
         self.set_state(DevState.ON)
 
-    # def read_save_data(self):
-    #     return self._save_data
-
-    # def write_save_data(self, value):
-    #     if self._save_data != value:
-    #         self.logger.info(f'save status is changed to {value}')
-    #     self._save_data = value
-    #     if value:
-    #         try:
-    #             os.makedirs(self._save_path, exist_ok=True)
-    #         except FileNotFoundError:
-    #             return
+    def delete_device(self):
+        self.shutdown_pipeline()
+        super().delete_device()
 
     def read_is_polling_periodically(self):
         return self._is_polling_periodically
@@ -344,7 +409,7 @@ class Vimba(Device):
 
     def write_trigger_source(self, attr):
         if self.camera.is_streaming():
-            self.camera.stop_streaming()
+            self.stop_streaming()
         if hasattr(attr, 'get_write_value'):
             value = attr.get_write_value()
         else:
@@ -363,39 +428,37 @@ class Vimba(Device):
 
     def read_is_new_image(self):
         # self.i, grabbing successfully grabbed image. self._image_number, image counting and can be reset at any time.
-        self._is_new_image = False
-        if self.imageq.qsize():
-            self._image = self.imageq.get()
-            self.push_change_event("image", self.read_image())
-            self._image_number += 1
-            self._read_time = datetime.datetime.now().strftime("%H-%M-%S.%f")
-            return True
-        else:
-            return False
+        self._is_new_image = self.process_next_frame()
+        return self._is_new_image
+
+    def acquire_frame(self):
+        frame, meta = self.frame_buffer.get()
+        if frame is None:
+            return None, None
+        created, self._image_number = meta
+        self._read_time = datetime.datetime.now().strftime("%H-%M-%S.%f")
+        return frame, created
 
     def read_image(self):
         return self._image
 
-    def disable_polling(self, attr):
-        if self.is_attribute_polled(attr):
-            self.stop_poll_attribute(attr)
-            self.logger.info(f'polling for {attr} is disabled')
-
-    def enable_polling(self, attr):
-        if not self.is_attribute_polled(attr):
-            if not self._polling:
-                self._polling = 200
-            self.poll_attribute(attr, self._polling)
-            self.logger.info(
-                f'polling period of {attr} is set to {self._polling}')
-
     def handler_one_by_one(self, cam: Camera, stream: Stream, frame: Frame):
         if frame.get_status() == FrameStatus.Complete:
             self.logger.info('Frame acquired: {}'.format(frame))
-            frame_array = np.squeeze(frame.as_numpy_ndarray())
-            self.imageq.put(frame_array)
-            self._image = frame_array
-            self.calculate_center_of_mass()
+            created = time.monotonic()
+            # numbered on arrival, so a frame dropped from the frame buffer leaves a gap in image_number
+            self._grabbed_number += 1
+            if self.frame_buffer.policy == 'block':
+                while not self.frame_buffer.wait_for_space(0.1) and not self._streaming_stop.is_set():
+                    pass
+            # the frame memory belongs to vmbpy, so it is copied once into a frame buffer slot before the frame is queued again
+            with self.stage_timer.measure('retrieve'):
+                is_stored = self.frame_buffer.put(np.squeeze(
+                    frame.as_numpy_ndarray()), (created, self._grabbed_number), timeout=0)
+            if not is_stored:
+                self.logger.warning(
+                    f'Frame buffer is full. {self.frame_buffer.dropped} frames dropped in total.')
+            self.announce_arrival()
         self.camera.queue_frame(frame)
 
     def handler_last_frame(self, cam: Camera, stream: Stream, frame: Frame):
@@ -406,6 +469,12 @@ class Vimba(Device):
             self.calculate_center_of_mass()
         self.camera.queue_frame(frame)
 
+    def stop_streaming(self):
+        # a callback waiting for a free frame buffer slot gives up, otherwise stop_streaming would wait for it forever
+        self._streaming_stop.set()
+        self.camera.stop_streaming()
+        self._streaming_stop.clear()
+
     @command()
     def get_ready(self):
         self.relax()
@@ -431,13 +500,15 @@ class Vimba(Device):
     @command()
     def relax(self):
         if self.camera.is_streaming():
-            self.camera.stop_streaming()
-            self.imageq = Queue()
+            self.stop_streaming()
+            self.frame_buffer.clear()
             self.logger.info("Grabbing stops")
 
     @command(dtype_in=int)
     def reset_number(self, number=0):
         self._image_number = number
+        self._grabbed_number = number
+        self.frame_buffer.reset_counters()
         self.logger.info("Reset image number")
 
 
@@ -0,0 +1,182 @@
+'''Offline re-analysis of saved camera images.
+
+Computes the same beam metrics as the camera servers (center of mass with the CoM filter, beam moments, and optionally energy and hot spot) for a folder of TIFF files or an HDF5 run file, and writes one row per shot to a csv table.
+
+    python -m common.batch_analysis D:\\data\\20250101\\run1\\Basler_1 -o metrics.csv --workers 8
+'''
+import os
+import re
+import csv
+import argparse
+import logging
+from dataclasses import dataclass, asdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from common.center_of_mass import ProjectionCenterOfMass, IntensityDistribution, apply_mask, remove_small_components
+from common.hot_spot import HotSpotFinder
+from common.image_transform import LumaConverter
+from common.raw_image import read_uncompressed
+
+image_extensions = ('.tif', '.tiff')
+container_extensions = ('.h5', '.hdf5')
+metric_columns = ['source', 'frame', 'shot', 'total', 'x', 'y', 'd4sigma_x', 'd4sigma_y', 'd4sigma_major', 'd4sigma_minor',
+                  'ellipticity', 'orientation', 'peak', 'peak_x', 'peak_y', 'CoM_filter_low', 'CoM_filter_high', 'energy', 'hot_spot', 'hot_spot_x', 'hot_spot_y']
+
+
+@dataclass
+class AnalysisSettings:
+    '''Counterpart of the CoM and calibration attributes of the camera servers. A filter value, when given, is used instead of its percentile.'''
+    CoM_filter_percentile_low: float = 0.999
+    CoM_filter_percentile_high: float = 1.0
+    CoM_filter_low: float = None
+    CoM_filter_high: float = None
+    small_object_min_area: int = 0
+    small_object_binning: int = 1
+    energy_coefficient: float = None
+    flux_coefficient: float = None
+    hot_spot_kernel: int = 0
+
+
+def shot_number(name):
+    '''shot or image number in a file name written by the DAQ or the camera server, or -1.'''
+    match = re.search(r'(?:Shot|ImageNum)(\d+)', name)
+    return int(match.group(1)) if match else -1
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def list_tasks(source, chunk_size=32):
+    '''split a folder of TIFF files or an HDF5 run file into chunks. Each task is (kind, source, items).'''
+    if os.path.isdir(source):
+        files = sorted([f for f in os.listdir(source) if f.lower().endswith(image_extensions)], key=_natural_key)
+        return [('tiff', source, files[i:i + chunk_size]) for i in range(0, len(files), chunk_size)]
+    if source.lower().endswith(container_extensions):
+        import h5py
+        with h5py.File(source, 'r') as f:
+            frames = len(f['image'])
+        return [('hdf5', source, (i, min(i + chunk_size, frames))) for i in range(0, frames, chunk_size)]
+    raise ValueError(f'{source} is neither a folder nor an HDF5 run file.')
+
+
+def load_chunk(kind, source, items):
+    '''return a list of (frames, names, shots) stacks. Frames of a different size than the previous one start a new stack.'''
+    if kind == 'hdf5':
+        import h5py
+        start, stop = items
+        with h5py.File(source, 'r') as f:
+            frames = f['image'][start:stop]
+            names = [n.decode() if isinstance(n, bytes) else str(n) for n in f['basename'][start:stop]]
+            shots = list(f['image_number'][start:stop])
+        return [(frames, names, shots)]
+    luma = LumaConverter()
+    stacks = []
+    for name in items:
+        # uncompressed files are mapped and only copied once, into the stack
+        frame = read_uncompressed(os.path.join(source, name), mmap=True)
+        if frame is None:
+            with Image.open(os.path.join(source, name)) as im:
+                frame = np.asarray(im)
+        if frame.ndim == 3:
+            frame = luma.convert(frame[:, :, :3])
+        if not stacks or stacks[-1][0][0].shape != frame.shape or stacks[-1][0][0].dtype != frame.dtype:
+            stacks.append(([], [], []))
+        stacks[-1][0].append(frame)
+        stacks[-1][1].append(name)
+        stacks[-1][2].append(shot_number(name))
+    return [(np.stack(frames), names, shots) for frames, names, shots in stacks]
+
+
+def _thresholds(frame, settings):
+    if settings.CoM_filter_low is not None and settings.CoM_filter_high is not None:
+        return settings.CoM_filter_low, settings.CoM_filter_high
+    distribution = IntensityDistribution(frame)
+    low = settings.CoM_filter_low if settings.CoM_filter_low is not None else distribution.value_at(
+        settings.CoM_filter_percentile_low)
+    high = settings.CoM_filter_high if settings.CoM_filter_high is not None else distribution.value_at(
+        settings.CoM_filter_percentile_high)
+    return low, high
+
+
+def analyse_stack(stack, settings, engine=None):
+    '''metrics of every frame of a (frames, height, width) stack, as a list of dicts.'''
+    engine = engine or ProjectionCenterOfMass()
+    thresholds = np.array([_thresholds(frame, settings) for frame in stack])
+    masked, mask = apply_mask(stack, thresholds[:, 0, None, None], thresholds[:, 1, None, None])
+    if settings.small_object_min_area > 0:
+        for i in range(len(stack)):
+            kept = remove_small_components(mask[i] & (masked[i] != 0), settings.small_object_min_area, settings.small_object_binning)
+            masked[i][~kept] = 0
+    moments = engine.compute_stack(masked)
+    if settings.energy_coefficient is not None:
+        energies = stack.sum(axis=(1, 2), dtype=np.float64) * settings.energy_coefficient
+    finder = HotSpotFinder(np.ones((settings.hot_spot_kernel,) * 2) / settings.hot_spot_kernel**2) \
+        if settings.hot_spot_kernel and settings.flux_coefficient is not None else None
+    rows = []
+    for i, result in enumerate(moments):
+        row = {'CoM_filter_low': thresholds[i, 0], 'CoM_filter_high': thresholds[i, 1]}
+        if result is not None:
+            row.update({'total': result.total, 'x': result.x, 'y': result.y, 'd4sigma_x': result.d4sigma_x, 'd4sigma_y': result.d4sigma_y,
+                        'd4sigma_major': result.d4sigma_major, 'd4sigma_minor': result.d4sigma_minor, 'ellipticity': result.ellipticity,
+                        'orientation': result.orientation, 'peak': result.peak, 'peak_x': result.peak_x, 'peak_y': result.peak_y})
+        if settings.energy_coefficient is not None:
+            row['energy'] = energies[i]
+        if finder is not None:
+            row['hot_spot'], (row['hot_spot_y'], row['hot_spot_x']) = finder.find(stack[i] * settings.flux_coefficient)
+        rows.append(row)
+    return rows
+
+
+def analyse_task(task, settings):
+    '''load and analyse one chunk. Runs in a worker process.'''
+    kind, source, items = task
+    engine = ProjectionCenterOfMass()
+    rows = []
+    for frames, names, shots in load_chunk(kind, source, items):
+        for name, shot, row in zip(names, shots, analyse_stack(frames, settings, engine)):
+            row.update({'source': name, 'shot': int(shot)})
+            rows.append(row)
+    return rows
+
+
+def analyse(source, output, settings=None, workers=None, chunk_size=32, logger=None):
+    '''analyse all frames of source with a process pool and write the metrics table to output. Return the number of frames.'''
+    settings = settings or AnalysisSettings()
+    tasks = list_tasks(source, chunk_size)
+    frame = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(output, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=metric_columns)
+        writer.writeheader()
+        # map keeps the order of the tasks, so the table is in shot order
+        for index, rows in enumerate(pool.map(analyse_task, tasks, [settings] * len(tasks))):
+            for row in rows:
+                row['frame'] = frame
+                frame += 1
+                writer.writerow(row)
+            if logger is not None:
+                logger.info(f'{index + 1}/{len(tasks)} chunks, {frame} frames')
+    return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch analysis of saved camera images.')
+    parser.add_argument('source', help='folder of TIFF files or HDF5 run file')
+    parser.add_argument('-o', '--output', default=None, help='csv file for the metrics table. Default is <source>_metrics.csv next to the source.')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes. Default is the number of CPUs.')
+    parser.add_argument('--chunk', type=int, default=32, help='frames per task')
+    defaults = AnalysisSettings()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f'--{name}', type=type(value) if value is not None else float, default=value)
+    args = parser.parse_args()
+    settings = AnalysisSettings(**{name: getattr(args, name) for name in asdict(defaults)})
+    output = args.output or os.path.splitext(os.path.abspath(args.source))[0] + '_metrics.csv'
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    number = analyse(args.source, output, settings, args.workers, args.chunk, logger)
+    logger.info(f'{number} frames analysed. The metrics are in {output}.')
+
+
+if __name__ == '__main__':
+    main()
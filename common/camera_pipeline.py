@@ -0,0 +1,390 @@
+import os
+import csv
+import datetime
+import logging
+from threading import Lock
+from PIL import Image
+from tango import AttrWriteType
+from tango.server import attribute
+from common.other import generate_basename
+from common.image_transform import LumaConverter, OrientationPlan
+from common.image_writer import ImageWriter, SaveJob, SaveWindow
+from common.run_container import HDF5RunWriter, new_run_path, save_formats
+from common.stage_timer import StageTimer
+
+
+class CameraPipeline:
+    '''Frame path shared by the camera servers: acquire -> transform -> analyse -> publish -> persist.
+
+    A server inherits from CameraPipeline before Device, e.g. ``class Vimba(CameraPipeline, Device)``, and implements acquire_frame() for its source (frame buffer filled by a grab thread or a camera callback, new files in a folder). acquire_frame() returns (frame, time.monotonic() of its arrival), or (None, None) if there is no new frame, and updates counters such as the image number. The other stages have defaults that the server extends when it has more to do, e.g. calibration in analyse_frame. read_is_new_image returns process_next_frame().
+
+    The server calls init_pipeline() in init_device, initialize_saving_attributes() in initialize_dynamic_attributes and shutdown_pipeline() in delete_device. Every stage is timed with self.stage_timer. The source should time its own work as "retrieve".
+    '''
+    pipeline_stages = ['retrieve', 'acquire',
+                       'transform', 'analyse', 'publish', 'persist']
+    saving_queue_size = 64
+    # name of the attribute counting the frames, used as image_number when saving
+    frame_counter = '_image_number'
+    # attribute counting the frames waiting to be processed. It is pushed when a frame arrives.
+    queue_attribute = 'frames_queued'
+    flux_path_string = "flux_image_with_hot_spot"
+
+    def init_pipeline(self, extra_stages=()):
+        self._save_data = False
+        self._save_path = ''
+        self.path_raw = ''
+        self._use_date = False
+        self._naming_format = '%t.%f'
+        self._save_format = 'tiff'
+        self._save_interval = 0
+        self._runs = {}
+        self._run_lock = Lock()
+        # one lock per save path, so that concurrent writers do not both create logging.csv
+        self._settings_locks = {}
+        self._settings_locks_guard = Lock()
+        self.luma_converter = LumaConverter()
+        if not hasattr(self, 'orientation'):
+            self.orientation = OrientationPlan()
+        self.stage_timer = StageTimer(
+            self.pipeline_stages + list(extra_stages))
+        self.set_change_event(self.frame_counter.lstrip('_'), True, False)
+        self.set_change_event(self.queue_attribute, True, False)
+
+    def start_saving(self):
+        '''create the writer service. It needs self.logger, so it is called once the logger exists. The writer is kept across Init so that frames already queued are still written.'''
+        if not hasattr(self, 'image_writer') or not self.image_writer.workers:
+            self.image_writer = ImageWriter(
+                self.write_job, max_queue_size=self.saving_queue_size, logger=self.logger)
+            if hasattr(self, 'save_window'):
+                self.save_window.close()
+            self.save_window = SaveWindow(
+                self.image_writer, self._save_interval, logger=self.logger)
+
+    def shutdown_pipeline(self):
+        if hasattr(self, 'image_writer'):
+            self.save_window.close()
+            self.image_writer.stop()
+            self.close_runs()
+
+    def process_next_frame(self):
+        '''run one frame through all stages. Return False if there is no new frame.'''
+        timer = self.stage_timer
+        with timer.measure('acquire'):
+            frame, created = self.acquire_frame()
+        if frame is None:
+            return False
+        with timer.measure('transform'):
+            self._image = self.transform_frame(frame)
+        with timer.measure('analyse'):
+            self.analyse_frame()
+        with timer.measure('publish'):
+            self.publish_frame()
+            self.announce_frame()
+        if self._save_data and self._save_path:
+            with timer.measure('persist'):
+                self.persist_frame(created)
+        return True
+
+    def transform_frame(self, frame):
+        '''RGB frames are converted to luma. Flips and rotation are applied as a view.'''
+        if frame.ndim == 3:
+            self._image_r = frame[:, :, 0]
+            self._image_g = frame[:, :, 1]
+            self._image_b = frame[:, :, 2]
+            frame = self.luma_converter.convert(frame)
+        return self.orientation.apply(frame)
+
+    def analyse_frame(self):
+        self.calculate_center_of_mass()
+
+    def publish_frame(self):
+        self.push_change_event("image", self._image)
+        if hasattr(self, 'publish_preview'):
+            self.publish_preview()
+
+    def announce_frame(self):
+        '''push the frame counter (image_number or file_number) after everything else of the frame is published.'''
+        self.push_change_event(self.frame_counter.lstrip('_'),
+                               getattr(self, self.frame_counter))
+
+    def announce_arrival(self):
+        '''push the number of waiting frames when the source gets a new frame. A client such as the DAQ waits for this event instead of polling is_new_image, and then reads is_new_image together with the data of the frame in one read_attributes call. The frame is only processed by that read, so the data belongs to it.'''
+        self.push_change_event(self.queue_attribute, getattr(
+            self, 'read_' + self.queue_attribute)())
+
+    def persist_frame(self, created):
+        # the frame is held for save_interval and only written if no other frame arrives too close to it
+        self.save_window.offer(SaveJob(basename=generate_basename(self._naming_format, self.naming_fields()), save_paths=self._save_path.split(';'),
+                                       image=self._image, log_row=self.frame_settings(), flux=self.frame_flux(), image_number=getattr(self, self.frame_counter),
+                                       save_format=self._save_format, created=created))
+
+    def naming_fields(self):
+        '''replacement of each placeholder of naming_format.'''
+        return {'%s': f'ImageNum{self._image_number}', '%t': f'Time{self._read_time}', '%f': 'tiff'}
+
+    def frame_settings(self):
+        '''row of logging.csv (or of the settings table of an HDF5 run) saved with the frame.'''
+        return {'_read_time': str(self._read_time), '_image_number': str(self._image_number)}
+
+    def frame_flux(self):
+        '''calibrated image saved next to the frame, or None.'''
+        return None
+
+    def write_job(self, job):
+        if job.save_format != 'tiff':
+            self.append_image_to_run(job)
+            return
+        for path in job.save_paths:
+            os.makedirs(path, exist_ok=True)
+            path_to_name = os.path.join(
+                path, job.basename)
+            Image.fromarray(job.image).save(path_to_name)
+            self.logger.info(
+                f"Image is save to {path_to_name}")
+            self.save_settings(path, job.log_row)
+            if job.flux is not None:
+                os.makedirs(os.path.join(
+                    path, self.flux_path_string), exist_ok=True)
+                parts = path_to_name.split(os.sep)
+                parts.insert(-1, self.flux_path_string)
+                Image.fromarray(job.flux).save(os.path.join(*parts))
+                self.logger.info(
+                    f"{self.flux_path_string} is save to {path_to_name}")
+
+    def save_settings(self, save_path, data_to_log):
+        '''write the important camera parameters and calibration data.'''
+        logging_file_path = os.path.join(save_path, 'logging.csv')
+        with self._settings_locks_guard:
+            lock = self._settings_locks.setdefault(
+                os.path.abspath(save_path), Lock())
+        try:
+            with lock:
+                to_do = 'w'
+                # if the file exists and the existing data is same as the current data, then skip. If the file exists but the data is different, append with 'a' mode. Else, overwrite with 'w' mode.
+                if os.path.isfile(logging_file_path):
+                    to_do = 'a'
+                with open(logging_file_path, to_do, newline='') as csvfile:
+                    writer = csv.DictWriter(
+                        csvfile, fieldnames=data_to_log.keys())
+                    if to_do == 'w':
+                        writer.writeheader()
+                    writer.writerow(data_to_log)
+        except ValueError:
+            self.logger.info(
+                f"Check the logging file at {logging_file_path}")
+
+    def append_image_to_run(self, job):
+        compression = save_formats[job.save_format]
+        for path in job.save_paths:
+            with self._run_lock:
+                run = self._runs.get(path)
+                if run is None or run.compression != compression or not run.accepts(job.image):
+                    if run is not None:
+                        run.close()
+                    os.makedirs(path, exist_ok=True)
+                    run = HDF5RunWriter(new_run_path(path), compression, logger=self.logger)
+                    self._runs[path] = run
+                    self.logger.info(f"New run file {run.path}")
+                index = run.append(job.image, job.log_row, job.basename,
+                                   job.image_number, job.flux)
+            self.logger.info(
+                f"Image {job.image_number} is appended to {run.path} as frame {index}")
+
+    def close_runs(self):
+        with self._run_lock:
+            for run in self._runs.values():
+                run.close()
+            self._runs = {}
+
+    def disable_polling(self, attr):
+        if self.is_attribute_polled(attr):
+            self.stop_poll_attribute(attr)
+            self.logger.info(f'polling for {attr} is disabled')
+
+    def enable_polling(self, attr):
+        if not self.is_attribute_polled(attr):
+            if not self._polling:
+                self._polling = 200
+            self.poll_attribute(attr, self._polling)
+            self.logger.info(
+                f'polling period of {attr} is set to {self._polling}')
+
+    def initialize_saving_attributes(self):
+        save_data = attribute(
+            name='save_data',
+            label="save data",
+            dtype=bool,
+            access=AttrWriteType.READ_WRITE,
+            memorized=True,
+            hw_memorized=True,
+            doc='save the images on the server'
+        )
+
+        save_path = attribute(
+            name='save_path',
+            label='save path (folder)',
+            dtype=str,
+            access=AttrWriteType.READ_WRITE,
+            memorized=True,
+            hw_memorized=True,
+            doc='Save data path on the server. Use %date to indicate today; Use ";" to separate multiple paths'
+        )
+
+        naming_format = attribute(
+            name='naming_format',
+            label='naming format',
+            dtype=str,
+            access=AttrWriteType.READ_WRITE,
+            memorized=True,
+            hw_memorized=True,
+            doc='Naming format for the image file. For example, "%s_%t.%f", where %s is for image number, %t is for timestamp and %f is tiff. Basler also has %e for energy and %h for hot spot. FileReader has %o for the original file name.'
+        )
+
+        save_interval = attribute(
+            name='save_interval',
+            label='save interval',
+            dtype=float,
+            access=AttrWriteType.READ_WRITE,
+            unit='s',
+            memorized=True,
+            hw_memorized=True,
+            doc='If the trigger interval is longer than the save_interval threshold, images will be saved. Otherwise, no saving. Each image is kept in memory for save_interval and only written if no other image arrives in the meantime.'
+        )
+
+        save_format = attribute(
+            name='save_format',
+            label='save format',
+            dtype=str,
+            access=AttrWriteType.READ_WRITE,
+            memorized=True,
+            hw_memorized=True,
+            doc=f'One of {list(save_formats)}. "tiff" saves one file per image with a logging.csv. "hdf5" appends the images and a settings table to one chunked HDF5 file per run in each save path. "hdf5_compressed" is the same with lzf compression. A new run file is started when the save path, the save format or the image size changes, or when saving is switched off.'
+        )
+
+        saving_workers = attribute(
+            name='saving_workers',
+            label='saving workers',
+            dtype=int,
+            access=AttrWriteType.READ_WRITE,
+            memorized=True,
+            hw_memorized=True,
+            doc='Number of threads writing the images to disk.'
+        )
+
+        saving_queue_depth = attribute(
+            name='saving_queue_depth',
+            label='saving queue depth',
+            dtype=int,
+            access=AttrWriteType.READ,
+            doc=f'Frames waiting to be written or being written. When the queue is full ({self.saving_queue_size} frames), new frames wait for the disk.'
+        )
+
+        saving_rate = attribute(
+            name='saving_rate',
+            label='saving rate',
+            dtype=float,
+            unit='B/s',
+            format='8.4e',
+            access=AttrWriteType.READ,
+            doc=f'Bytes written per second, averaged over the last {ImageWriter.rate_window} s.'
+        )
+
+        saving_lag = attribute(
+            name='saving_lag',
+            label='saving lag',
+            dtype=float,
+            unit='s',
+            access=AttrWriteType.READ,
+            doc='Age of the oldest frame that is not written yet.'
+        )
+
+        for attr in [save_data, save_path, naming_format, save_interval, save_format, saving_workers, saving_queue_depth, saving_rate, saving_lag]:
+            self.add_attribute(attr)
+
+    def read_save_data(self, attr=None):
+        return self._save_data
+
+    def write_save_data(self, attr):
+        value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+        if self._save_data != value:
+            self.logger.info(f'save status is changed to {value}')
+            if not value:
+                self.close_runs()
+        self._save_data = value
+        if value:
+            try:
+                os.makedirs(self._save_path, exist_ok=True)
+            except FileNotFoundError:
+                return
+
+    def read_save_path(self, attr=None):
+        if self._use_date and datetime.datetime.today().strftime("%Y%m%d") not in self._save_path:
+            self.write_save_path(self.path_raw)
+        return self._save_path
+
+    def write_save_path(self, attr):
+        value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+        # if the entered path has %date in it, replace %date with today's date and mark a _use_date flag
+        self.path_raw = value
+        if '%date' in value:
+            self._use_date = True
+            value = value.replace(
+                '%date', datetime.datetime.today().strftime("%Y%m%d"))
+        else:
+            self._use_date = False
+        value_split = value.split(';')
+        if value != self._save_path:
+            self.close_runs()
+        if self._save_data:
+            for idx, v in enumerate(value_split):
+                try:
+                    os.makedirs(v, exist_ok=True)
+                except OSError as inst:
+                    logging.error(inst)
+                    raise Exception(f'error on save_path part {idx}')
+        self._save_path = value
+        self.push_change_event("save_path", self.read_save_path())
+
+    def read_naming_format(self, attr=None):
+        return self._naming_format
+
+    def write_naming_format(self, attr):
+        value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+        self._naming_format = value
+
+    def read_save_interval(self, attr=None):
+        return self._save_interval
+
+    def write_save_interval(self, attr):
+        value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+        self._save_interval = value
+        self.save_window.window = value
+
+    def read_save_format(self, attr=None):
+        return self._save_format
+
+    def write_save_format(self, attr):
+        value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+        if value not in save_formats:
+            raise Exception(f'Must be one of {list(save_formats)}.')
+        if value != self._save_format:
+            self._save_format = value
+            self.close_runs()
+
+    def read_saving_workers(self, attr=None):
+        return self.image_writer.workers
+
+    def write_saving_workers(self, attr):
+        value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+        if value < 1:
+            raise Exception('Must be at least 1.')
+        self.image_writer.set_workers(value)
+
+    def read_saving_queue_depth(self, attr=None):
+        return self.image_writer.queue_depth
+
+    def read_saving_rate(self, attr=None):
+        return self.image_writer.bytes_per_second
+
+    def read_saving_lag(self, attr=None):
+        return self.image_writer.oldest_pending_age
@@ -0,0 +1,189 @@
+from dataclasses import dataclass, replace
+import numpy as np
+from scipy import ndimage
+
+
+@dataclass
+class BeamMoments:
+    '''First and second moments, peak and total of a beam image. Lengths are in pixels, orientation in degrees.'''
+    total: float
+    x: float
+    y: float
+    sigma_xx: float
+    sigma_yy: float
+    sigma_xy: float
+    peak: float
+    peak_x: int
+    peak_y: int
+
+    @property
+    def d4sigma_x(self):
+        return 4 * np.sqrt(self.sigma_xx)
+
+    @property
+    def d4sigma_y(self):
+        return 4 * np.sqrt(self.sigma_yy)
+
+    def _principal_term(self):
+        return np.sqrt((self.sigma_xx - self.sigma_yy)**2 + 4 * self.sigma_xy**2)
+
+    @property
+    def d4sigma_major(self):
+        '''beam width along the major axis of the ellipse, as in ISO 11146.'''
+        return 2 * np.sqrt(2) * np.sqrt(max(self.sigma_xx + self.sigma_yy + self._principal_term(), 0.0))
+
+    @property
+    def d4sigma_minor(self):
+        return 2 * np.sqrt(2) * np.sqrt(max(self.sigma_xx + self.sigma_yy - self._principal_term(), 0.0))
+
+    @property
+    def ellipticity(self):
+        '''minor over major width, 1 for a round beam.'''
+        major = self.d4sigma_major
+        return self.d4sigma_minor / major if major > 0 else 1.0
+
+    @property
+    def orientation(self):
+        '''angle between the x axis and the major axis. y points down the image, so a positive angle is clockwise on screen.'''
+        return float(np.degrees(0.5 * np.arctan2(2 * self.sigma_xy, self.sigma_xx - self.sigma_yy)))
+
+    def shifted(self, dx, dy):
+        '''the same moments in the coordinates of a larger image, for moments computed in an ROI at (dx, dy).'''
+        return replace(self, x=self.x + dx, y=self.y + dy, peak_x=self.peak_x + dx, peak_y=self.peak_y + dy)
+
+
+class ProjectionCenterOfMass:
+    '''Center of mass and second moments from the row and column sums of the image.
+
+    sum(x * I) over the image equals the dot product of the column sums with the x coordinates, so only two 1-D projections are needed instead of full-size index and product arrays. The same holds for sum(x**2 * I) and sum(y**2 * I). The cross term sum(x * y * I) is the product of y with image @ x, done in blocks of rows so that integer images are converted to float only block by block. The coordinate vectors are kept per image shape and the sums are accumulated in float64.
+    '''
+    block_rows = 256
+
+    def __init__(self):
+        self._coordinates = {}
+
+    def coordinates(self, shape):
+        '''(y, x) coordinate vectors for an image of this shape.'''
+        if shape not in self._coordinates:
+            self._coordinates[shape] = (np.arange(shape[0], dtype=np.float64),
+                                        np.arange(shape[1], dtype=np.float64))
+        return self._coordinates[shape]
+
+    def compute(self, image):
+        '''return BeamMoments, or None if the total intensity is not positive.'''
+        row_sums = image.sum(axis=1, dtype=np.float64)
+        total_intensity = row_sums.sum()
+        if total_intensity <= 0:
+            return None
+        column_sums = image.sum(axis=0, dtype=np.float64)
+        y, x = self.coordinates(image.shape)
+        mean_x = column_sums @ x / total_intensity
+        mean_y = row_sums @ y / total_intensity
+        peak_y, peak_x = np.unravel_index(np.argmax(image), image.shape)
+        return BeamMoments(total=float(total_intensity), x=float(mean_x), y=float(mean_y),
+                           sigma_xx=max(float(column_sums @ x**2 / total_intensity - mean_x**2), 0.0),
+                           sigma_yy=max(float(row_sums @ y**2 / total_intensity - mean_y**2), 0.0),
+                           sigma_xy=float(self._cross_sum(image) / total_intensity - mean_x * mean_y),
+                           peak=float(image[peak_y, peak_x]), peak_x=int(peak_x), peak_y=int(peak_y))
+
+    def _cross_sum(self, image):
+        '''sum(x * y * image).'''
+        y, x = self.coordinates(image.shape)
+        cross = 0.0
+        for start in range(0, image.shape[0], self.block_rows):
+            block = image[start:start + self.block_rows]
+            cross += y[start:start + self.block_rows] @ (block @ x)
+        return cross
+
+    def compute_stack(self, stack):
+        '''BeamMoments (or None) for every frame of a (frames, height, width) stack. The projections and peaks are computed for the whole stack at once.'''
+        row_sums = stack.sum(axis=2, dtype=np.float64)
+        column_sums = stack.sum(axis=1, dtype=np.float64)
+        totals = row_sums.sum(axis=1)
+        y, x = self.coordinates(stack.shape[1:])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_x = column_sums @ x / totals
+            mean_y = row_sums @ y / totals
+            sigma_xx = column_sums @ x**2 / totals - mean_x**2
+            sigma_yy = row_sums @ y**2 / totals - mean_y**2
+        peak_indices = stack.reshape(len(stack), -1).argmax(axis=1)
+        results = []
+        for i, frame in enumerate(stack):
+            if totals[i] <= 0:
+                results.append(None)
+                continue
+            peak_y, peak_x = np.unravel_index(peak_indices[i], frame.shape)
+            results.append(BeamMoments(total=float(totals[i]), x=float(mean_x[i]), y=float(mean_y[i]),
+                                       sigma_xx=max(float(sigma_xx[i]), 0.0), sigma_yy=max(float(sigma_yy[i]), 0.0),
+                                       sigma_xy=float(self._cross_sum(frame) / totals[i] - mean_x[i] * mean_y[i]),
+                                       peak=float(frame[peak_y, peak_x]), peak_x=int(peak_x), peak_y=int(peak_y)))
+        return results
+
+
+def apply_mask(image, low, high):
+    '''copy of the image in its own dtype with the pixels outside [low, high] set to 0, and the mask itself.'''
+    mask = image >= low
+    mask &= image <= high
+    return np.where(mask, image, 0).astype(image.dtype, copy=False), mask
+
+
+class IntensityDistribution:
+    '''Cumulative intensity distribution of one frame, used to convert between CoM filter values and percentiles.
+
+    uint8 and uint16 images are counted with one bincount pass. Both directions are then lookups in the cumulative histogram, and value_at gives the same result as np.percentile with linear interpolation. Other dtypes use a sorted sample of at most max_samples pixels, which is exact for smaller images.
+    '''
+    max_samples = 1 << 18
+
+    def __init__(self, image):
+        self.size = image.size
+        if image.dtype in (np.uint8, np.uint16):
+            self.cumulative = np.cumsum(np.bincount(
+                image.ravel(), minlength=np.iinfo(image.dtype).max + 1))
+            self.sorted_sample = None
+        else:
+            self.cumulative = None
+            step = max(1, -(-image.size // self.max_samples))
+            self.sorted_sample = np.sort(image.ravel()[::step])
+
+    def value_at(self, fraction):
+        '''intensity below which the given fraction (0 to 1) of the pixels lies.'''
+        if self.cumulative is None:
+            return float(np.percentile(self.sorted_sample, fraction * 100.0))
+        rank = fraction * (self.size - 1)
+        lower_rank = int(np.floor(rank))
+        upper_rank = min(lower_rank + 1, self.size - 1)
+        lower, upper = np.searchsorted(
+            self.cumulative, [lower_rank, upper_rank], side='right')
+        return float(lower + (rank - lower_rank) * (upper - lower))
+
+    def fraction_at_or_below(self, value):
+        '''fraction of the pixels with intensity <= value.'''
+        if self.cumulative is None:
+            return float(np.searchsorted(self.sorted_sample, value, side='right') / len(self.sorted_sample))
+        if value < 0:
+            return 0.0
+        index = min(int(np.floor(value)), len(self.cumulative) - 1)
+        return float(self.cumulative[index] / self.size)
+
+
+def remove_small_components(mask, min_area, binning=1):
+    '''drop the connected regions of a boolean mask that are smaller than min_area pixels.
+
+    With binning > 1, the mask is reduced by binning x binning blocks (a block is set if any of its pixels is set) before labeling, and the labels are expanded back. This is faster on large frames. Nearby pixels in neighbouring blocks join one region, but the areas are still counted in full resolution pixels, so a single hot pixel is removed at any binning. Only the pixels of the original mask are kept.
+    '''
+    if binning > 1:
+        height, width = mask.shape[0] // binning, mask.shape[1] // binning
+        binned = mask[:height * binning, :width * binning].reshape(
+            height, binning, width, binning).any(axis=(1, 3))
+        # 8-connectivity, like the 3x3 square used by the erosion engine
+        labels, count = ndimage.label(binned, structure=np.ones((3, 3)))
+        # pixels beyond the last full block belong to the last block
+        rows = np.minimum(np.arange(mask.shape[0]) // binning, height - 1)
+        columns = np.minimum(np.arange(mask.shape[1]) // binning, width - 1)
+        labels = labels[np.ix_(rows, columns)]
+    else:
+        labels, count = ndimage.label(mask, structure=np.ones((3, 3)))
+    sizes = np.bincount(labels[mask], minlength=count + 1)
+    keep = sizes >= min_area
+    keep[0] = False
+    return mask & keep[labels]
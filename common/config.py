@@ -27,4 +27,7 @@ image_panel_config = {
 }
 
 # "40330527" is TA3 ESPECH, "40222934" is test camera. Now the GUI will always show the MeV mark if image_with_MeV_mark attribute exists in the device server.
-basler_server_config = {"mev_mark": {"serial_number": ["40222934"]}}
+# "energy_GeV" and "pixel" are the electron energies of the MeV marks and their pixel positions along the dispersion axis of the camera.
+basler_server_config = {"mev_mark": {"serial_number": ["40222934"],
+                                     "energy_GeV": [0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0, 2.5, 3.0, 3.3, 3.5, 3.8, 4.0, 4.3],
+                                     "pixel": [int((72 - d) * 70 + 324) for d in [11.6, 23.5, 29.3, 34.1, 37.9, 42.9, 47.6, 51.4, 54.5, 60.3, 64.4, 66.3, 67.4, 68.8, 69.6, 70.8]]}}
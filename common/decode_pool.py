@@ -0,0 +1,119 @@
+import collections
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import sif_parser
+from PIL import Image
+from common.file_completion import FileCompletion
+from common.raw_image import read_uncompressed
+
+mode_to_bpp = {"1": 1, "L": 8, "P": 8, "RGB": 24, "RGBA": 32, "CMYK": 32, "YCbCr": 24, "LAB": 24, "HSV": 24, "I": 32, "F": 32, "I;16": 16,
+               "I;16B": 16, "I;16L": 16, "I;16S": 16, "I;16BS": 16, "I;16LS": 16, "I;32": 32, "I;32B": 32, "I;32L": 32, "I;32S": 32, "I;32BS": 32, "I;32LS": 32}
+
+
+def decode_image_file(path, raw_format='', out=None):
+    '''(image, pixel format) of an Andor SIF file, an uncompressed TIFF or raw file (read into out if it is large enough) or any image file PIL can open.'''
+    if path.endswith('.sif'):
+        image, info = sif_parser.np_open(path)
+        return np.squeeze(image), '16'
+    image = read_uncompressed(path, raw_format, out)
+    if image is not None:
+        return image, str(image.itemsize * 8 * (image.shape[2] if image.ndim == 3 else 1))
+    with Image.open(path) as image_PIL:
+        return np.array(image_PIL), str(mode_to_bpp[image_PIL.mode])
+
+
+def _decode_into(path, completion, block_name, capacity, raw_format):
+    '''runs in a worker process. Uncompressed files are read straight into the shared block. Other frames are copied into it if they fit, else returned through the pipe.'''
+    # the workers share the resource tracker of the device server, so attaching does not make the worker an owner of the block
+    block = shared_memory.SharedMemory(name=block_name)
+    buffer = np.ndarray(capacity, np.uint8, buffer=block.buf)
+    try:
+        image, pixel_format = completion.read(path, functools.partial(
+            decode_image_file, raw_format=raw_format, out=buffer))
+        if np.shares_memory(image, buffer):
+            return None, image.shape, image.dtype.str, pixel_format
+        if image.nbytes > capacity:
+            return image, image.shape, image.dtype.str, pixel_format
+        np.ndarray(image.shape, image.dtype, buffer=block.buf)[...] = image
+        return None, image.shape, image.dtype.str, pixel_format
+    finally:
+        buffer = image = None
+        try:
+            block.close()
+        except BufferError:
+            # a traceback still holds a view of the block. It is unmapped when the view is collected.
+            pass
+
+
+class DecodePool:
+    '''Decode image files in worker processes, several files ahead of the consumer.
+
+    Each file in flight has a block of shared memory owned by this process. The worker waits until the file is complete, decodes it into the block, and only the shape and dtype go back through the pipe. A frame larger than the blocks comes back pickled once, and the blocks are grown for the following files. Results are returned in the order the files were submitted.
+    '''
+
+    def __init__(self, workers=2, completion=None):
+        self.workers = workers
+        self.max_in_flight = 2 * workers
+        self.completion = completion or FileCompletion()
+        # spawn, since forking a device server with running threads is not safe
+        self._executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+        self._capacity = 1
+        self._free = []
+        self._pending = collections.deque()
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def ready(self):
+        '''the oldest file in flight is decoded, so result() returns at once.'''
+        return bool(self._pending) and self._pending[0][1].done()
+
+    def full(self):
+        return len(self._pending) >= self.max_in_flight
+
+    def submit(self, path, raw_format=''):
+        block = self._free.pop() if self._free else shared_memory.SharedMemory(
+            create=True, size=self._capacity)
+        future = self._executor.submit(
+            _decode_into, path, self.completion, block.name, block.size, raw_format)
+        self._pending.append((path, future, block))
+
+    def result(self):
+        '''(path, image, pixel format, error) of the oldest file in flight. error is None or the exception raised by decoding.'''
+        path, future, block = self._pending.popleft()
+        try:
+            image, shape, dtype, pixel_format = future.result()
+            if image is None:
+                image = np.ndarray(shape, dtype, buffer=block.buf).copy()
+            else:
+                self._capacity = max(self._capacity, image.nbytes)
+            return path, image, pixel_format, None
+        except Exception as e:
+            return path, None, None, e
+        finally:
+            self._recycle(block)
+
+    def _recycle(self, block):
+        if block.size >= self._capacity:
+            self._free.append(block)
+        else:
+            block.close()
+            block.unlink()
+
+    def close(self):
+        '''stop the workers and free the blocks. Files in flight are dropped and returned.'''
+        paths = [path for path, future, block in self._pending]
+        for path, future, block in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for block in self._free + [block for path, future, block in self._pending]:
+            block.close()
+            block.unlink()
+        self._free = []
+        self._pending.clear()
+        return paths
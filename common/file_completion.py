@@ -0,0 +1,99 @@
+import os
+import time
+
+
+class FileCompletion:
+    '''Decide when a file written by another program (camera software, oscilloscope) is complete, and parse it with a bounded number of attempts.
+
+    A file is complete once its size and modification time have not changed for window seconds, measured with the local clock from the first look at the file. Files whose modification time is already more than settled_age seconds old are taken as complete at once, so a backlog of old files is read without waiting. If parsing still fails, the file is looked at again after another window, at most attempts times in total, and the last error is raised.
+
+    wait and read block the calling thread. poll does one look per call and is meant for a Tango request thread, which must not be held for the whole timeout.
+    '''
+    settled_age = 1.0
+
+    def __init__(self, window=0.05, attempts=3, timeout=10.0):
+        if attempts < 1:
+            raise ValueError('attempts must be at least 1.')
+        self.window = window
+        self.attempts = int(attempts)
+        self.timeout = timeout
+        # state of the files looked at by poll, by path
+        self._polled = {}
+
+    def _look(self, path, state):
+        '''look at path once. Return True if it is complete, None if it vanished, stayed empty or kept changing for timeout seconds, else False.'''
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        now = time.monotonic()
+        current = (stat.st_size, stat.st_mtime_ns)
+        if stat.st_size > 0:
+            if state['last'] is None and time.time() - stat.st_mtime >= self.settled_age:
+                return True
+            if current == state['last'] and now - state['stable_since'] >= self.window:
+                return True
+        if current != state['last']:
+            state['last'] = current
+            state['stable_since'] = now
+        if now - state['start'] >= self.timeout:
+            return None
+        return False
+
+    @staticmethod
+    def _new_state(not_before=0.0):
+        now = time.monotonic()
+        return {'start': now, 'last': None, 'stable_since': now, 'failures': 0, 'not_before': not_before}
+
+    def wait(self, path, stop_event=None):
+        '''block until path is complete. Return False if it vanished, stayed empty or kept changing for timeout seconds.'''
+        state = self._new_state()
+        while True:
+            complete = self._look(path, state)
+            if complete is not False:
+                return bool(complete)
+            if stop_event is not None and stop_event.is_set():
+                return False
+            time.sleep(max(self.window / 4, 0.001))
+
+    def read(self, path, parse, stop_event=None):
+        '''wait for path to be complete and return parse(path). The last error is raised once all attempts failed.'''
+        for attempt in range(self.attempts):
+            if not self.wait(path, stop_event):
+                raise TimeoutError(
+                    f'{path} is missing, empty or still changing after {self.timeout} s.')
+            try:
+                return parse(path)
+            except Exception:
+                if attempt == self.attempts - 1:
+                    raise
+                time.sleep(self.window)
+
+    def poll(self, path, parse):
+        '''same as read without blocking, for callers that must answer at once. Return (True, parse(path)) once path is complete and parsed, or (False, None) if it has to be polled again later.'''
+        state = self._polled.setdefault(path, self._new_state())
+        if time.monotonic() < state['not_before']:
+            return False, None
+        complete = self._look(path, state)
+        if complete is None:
+            del self._polled[path]
+            raise TimeoutError(
+                f'{path} is missing, empty or still changing after {self.timeout} s.')
+        if not complete:
+            return False, None
+        try:
+            data = parse(path)
+        except Exception:
+            if state['failures'] + 1 >= self.attempts:
+                del self._polled[path]
+                raise
+            # looked at again after another window
+            self._polled[path] = self._new_state(time.monotonic() + self.window)
+            self._polled[path]['failures'] = state['failures'] + 1
+            return False, None
+        del self._polled[path]
+        return True, data
+
+    def forget(self):
+        '''drop the state of the polled files, e.g. when the queue of files is cleared.'''
+        self._polled.clear()
@@ -0,0 +1,141 @@
+import os
+import csv
+import threading
+
+
+class FolderIndex:
+    '''Index of the data files of a watched folder: name, size, mtime, extension and the shape found when the file was parsed.
+
+    A folder that does not exist gives an empty index. The entries are in the order the files were written (mtime, then name), so file N is the N-th entry. The index is stored in the folder as an append-only csv log: each new or parsed file appends one row, and a later row for the same name replaces the earlier one. scan() brings the index up to date with the folder, e.g. after a restart, and rewrites the log compactly. If the folder is not writable, the index is only kept in memory.
+    '''
+    index_name = '.file_reader_index'
+    columns = ['name', 'size', 'mtime', 'extension', 'shape']
+
+    def __init__(self, folder, extensions, logger=None):
+        self.folder = folder
+        self.extensions = tuple(extensions)
+        self.logger = logger
+        self.path = os.path.join(folder, self.index_name) if os.path.isdir(folder) else None
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._order = []
+        self._load()
+
+    def __len__(self):
+        return len(self._order)
+
+    def _load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, newline='') as f:
+                for row in csv.DictReader(f):
+                    self._set({'name': row['name'], 'size': int(row['size']), 'mtime': float(row['mtime']),
+                               'extension': row['extension'], 'shape': row['shape']})
+        except (OSError, csv.Error, KeyError, TypeError, ValueError) as e:
+            # a damaged log is rebuilt by the next scan
+            if self.logger is not None:
+                self.logger.warning(f'Cannot load {self.path}: {e}')
+
+    def _set(self, entry):
+        if entry['name'] not in self._entries:
+            self._order.append(entry['name'])
+        self._entries[entry['name']] = entry
+
+    @staticmethod
+    def _entry(name, stat, shape=''):
+        return {'name': name, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'extension': os.path.splitext(name)[1].lstrip('.'), 'shape': shape}
+
+    def _write(self, entries, mode):
+        if self.path is None:
+            return
+        try:
+            is_new = mode == 'w' or not os.path.isfile(self.path)
+            with open(self.path, mode, newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.columns)
+                if is_new:
+                    writer.writeheader()
+                writer.writerows(entries)
+        except OSError as e:
+            if self.logger is not None:
+                self.logger.warning(
+                    f'The index of {self.folder} is only kept in memory: {e}')
+            self.path = None
+
+    def _rewrite(self, entries):
+        if self.path is None:
+            return
+        path = self.path
+        self.path += '.tmp'
+        self._write(entries, 'w')
+        if self.path is not None:
+            try:
+                os.replace(self.path, path)
+                self.path = path
+            except OSError as e:
+                if self.logger is not None:
+                    self.logger.warning(
+                        f'The index of {self.folder} is only kept in memory: {e}')
+                self.path = None
+
+    def add(self, path, shape=None):
+        '''index a new file or update the entry of a file. shape is given once the file is parsed.'''
+        name = os.path.basename(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            if shape is None:
+                shape = self._entries[name]['shape'] if name in self._entries else ''
+            else:
+                shape = 'x'.join(str(n) for n in shape)
+            entry = self._entry(name, stat, shape)
+            self._set(entry)
+            self._write([entry], 'a')
+
+    def scan(self):
+        '''bring the index up to date with the folder. Return the positions of the files that were not indexed yet.'''
+        if not os.path.isdir(self.folder):
+            return []
+        with os.scandir(self.folder) as it:
+            files = {e.name: e.stat() for e in it if e.is_file()
+                     and e.name.endswith(self.extensions) and e.name != self.index_name}
+        with self._lock:
+            kept = [name for name in self._order if name in files]
+            new = sorted((name for name in files if name not in self._entries),
+                         key=lambda name: (files[name].st_mtime, name))
+            entries = {}
+            for name in kept:
+                entry = self._entries[name]
+                stat = files[name]
+                if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                    # the file was rewritten, its shape is not known any more
+                    entry = self._entry(name, stat)
+                entries[name] = entry
+            for name in new:
+                entries[name] = self._entry(name, files[name])
+            self._entries = entries
+            self._order = kept + new
+            self._rewrite([entries[name] for name in self._order])
+            return list(range(len(kept), len(self._order)))
+
+    def name(self, position):
+        '''name of file N. Negative positions count from the newest file.'''
+        with self._lock:
+            return self._order[position]
+
+    def names(self, first, last):
+        '''names of files first to last, both included. Negative positions count from the newest file. Raise IndexError if a position is out of range or first comes after last.'''
+        with self._lock:
+            count = len(self._order)
+            start, stop = (p + count if p < 0 else p for p in (first, last))
+            if not 0 <= start <= stop < count:
+                raise IndexError(
+                    f'Files {first} to {last} are not a range of the {count} files in the index.')
+            return self._order[start:stop + 1]
+
+    def entry(self, position):
+        with self._lock:
+            return dict(self._entries[self._order[position]])
@@ -0,0 +1,129 @@
+import threading
+import numpy as np
+
+
+class FrameRingBuffer:
+    '''Fixed-capacity FIFO of preallocated frame slots shared by a producer thread (the camera grab loop or frame callback) and a consumer (the processing/publishing stage).
+
+    The slots are allocated on the first frame and reused afterwards. They are only reallocated when the frame shape or dtype changes, e.g. after changing width, height or pixel format. The policy decides what happens when the buffer is full:
+    "drop_oldest" overwrites the oldest queued frame, "drop_newest" discards the incoming frame, and "block" waits until the consumer frees a slot (up to the timeout given to put, after which the incoming frame is discarded). Every discarded frame is counted in dropped.
+    '''
+    policies = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, capacity=16, policy='drop_oldest'):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1.')
+        self.capacity = int(capacity)
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._slots = None
+        self._meta = [None] * self.capacity
+        self._head = 0
+        self._count = 0
+        self.dropped = 0
+        self.processed = 0
+        self.peak_occupancy = 0
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @policy.setter
+    def policy(self, value):
+        if value not in self.policies:
+            raise ValueError(f'policy must be one of {", ".join(self.policies)}.')
+        self._policy = value
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def queued(self):
+        return self._count
+
+    def _allocate(self, shape, dtype):
+        self._slots = np.empty((self.capacity,) + tuple(shape), dtype=dtype)
+        self._meta = [None] * self.capacity
+        self._head = 0
+        self._count = 0
+
+    def _fits(self, frame):
+        return self._slots is not None and self._slots.shape[1:] == frame.shape and self._slots.dtype == frame.dtype
+
+    def put(self, frame, meta=None, timeout=None):
+        '''copy the frame into the next free slot. Return False if a frame (an older one or this one, depending on the policy) was dropped.'''
+        frame = np.asarray(frame)
+        with self._lock:
+            if self._policy == 'block':
+                self._not_full.wait_for(lambda: self._count < self.capacity or not self._fits(frame), timeout)
+            if not self._fits(frame):
+                self.dropped += self._count
+                self._allocate(frame.shape, frame.dtype)
+            is_dropped = self._count == self.capacity
+            if is_dropped and self._policy != 'drop_oldest':
+                self.dropped += 1
+                return False
+            if is_dropped:
+                self._head = (self._head + 1) % self.capacity
+                self._count -= 1
+                self.dropped += 1
+            tail = (self._head + self._count) % self.capacity
+            np.copyto(self._slots[tail], frame)
+            self._meta[tail] = meta
+            self._count += 1
+            self.peak_occupancy = max(self.peak_occupancy, self._count)
+            self._not_empty.notify()
+        return not is_dropped
+
+    def wait_for_space(self, timeout=None):
+        '''block until a slot is free, so that the next put does not drop a frame. Return False on timeout.'''
+        with self._lock:
+            return self._not_full.wait_for(lambda: self._count < self.capacity, timeout)
+
+    def get(self, latest=False, timeout=None):
+        '''return a copy of the oldest frame and its meta data, or (None, None) if no frame arrives within timeout. With latest=True, older frames are discarded (and counted as dropped) and the newest one is returned.'''
+        with self._not_empty:
+            if not self._count and timeout:
+                self._not_empty.wait(timeout)
+            if not self._count:
+                return None, None
+            if latest and self._count > 1:
+                self.dropped += self._count - 1
+                self._head = (self._head + self._count - 1) % self.capacity
+                self._count = 1
+            frame = self._slots[self._head].copy()
+            meta = self._meta[self._head]
+            self._meta[self._head] = None
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+            self.processed += 1
+            self._not_full.notify()
+        return frame, meta
+
+    def clear(self):
+        with self._lock:
+            self._meta = [None] * self.capacity
+            self._head = 0
+            self._count = 0
+            self._not_full.notify_all()
+
+    def reset_counters(self):
+        with self._lock:
+            self.dropped = 0
+            self.processed = 0
+            self.peak_occupancy = self._count
+
+    def resize(self, capacity):
+        '''change the number of slots. Queued frames are discarded.'''
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1.')
+        with self._lock:
+            self.dropped += self._count
+            self.capacity = int(capacity)
+            self._slots = None
+            self._meta = [None] * self.capacity
+            self._head = 0
+            self._count = 0
+            self._not_full.notify_all()
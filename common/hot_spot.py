@@ -0,0 +1,69 @@
+import numpy as np
+from scipy.ndimage import convolve1d
+from scipy.signal import fftconvolve
+
+
+def box_sum(image, ky, kx):
+    '''Sum of every ky*kx window centered on each pixel, with zeros outside of the image. Computed with a summed-area table.'''
+    # same window alignment as scipy.ndimage.convolve, which matters for even kernel sizes
+    before_y, before_x = (ky - 1) // 2, (kx - 1) // 2
+    padded = np.pad(image, ((before_y + 1, ky - 1 - before_y),
+                    (before_x + 1, kx - 1 - before_x)))
+    sat = padded.cumsum(axis=0).cumsum(axis=1)
+    return sat[ky:, kx:] - sat[:-ky, kx:] - sat[ky:, :-kx] + sat[:-ky, :-kx]
+
+
+class HotSpotFinder:
+    '''Locate the maximum of an image smoothed by a kernel, i.e. the maximum of scipy.ndimage.convolve(image, kernel, mode='constant').
+
+    The kernel is inspected once. A kernel with identical entries (box kernel) uses a summed-area table. A kernel of rank one (separable kernel) uses two 1D convolutions. Any other kernel uses an FFT convolution.
+    '''
+
+    def __init__(self, kernel):
+        self.kernel = np.asarray(kernel, dtype=np.float64)
+        if self.kernel.ndim != 2:
+            raise ValueError('kernel must be 2D.')
+        if np.all(self.kernel == self.kernel.flat[0]):
+            self.method = 'box'
+        else:
+            u, s, vt = np.linalg.svd(self.kernel)
+            if len(s) == 1 or s[1] <= 1e-12 * s[0]:
+                self.method = 'separable'
+                self._column = u[:, 0] * s[0]
+                self._row = vt[0]
+            else:
+                self.method = 'fft'
+
+    def smooth(self, image):
+        image = np.asarray(image, dtype=np.float64)
+        if self.method == 'box':
+            return box_sum(image, *self.kernel.shape) * self.kernel.flat[0]
+        if self.method == 'separable':
+            return convolve1d(convolve1d(image, self._column, axis=0, mode='constant'), self._row, axis=1, mode='constant')
+        ky, kx = self.kernel.shape
+        full = fftconvolve(image, self.kernel, mode='full')
+        return full[ky // 2:ky // 2 + image.shape[0], kx // 2:kx // 2 + image.shape[1]]
+
+    def find(self, image):
+        '''return the hot spot value and its (row, column) location.'''
+        smoothed = self.smooth(image)
+        index = np.unravel_index(np.argmax(smoothed), smoothed.shape)
+        return smoothed[index], index
+
+
+def draw_rectangle(image, top_left, bottom_right, value, width=1):
+    '''Draw the outline of a rectangle in place. Corners are (x, y) and inclusive, like PIL ImageDraw.rectangle. The outline grows inwards and the parts outside of the image are clipped.'''
+    x0, y0 = int(top_left[0]), int(top_left[1])
+    x1, y1 = int(bottom_right[0]), int(bottom_right[1])
+    if x1 < x0 or y1 < y0:
+        return image
+
+    def fill(row_start, row_stop, column_start, column_stop):
+        image[max(row_start, 0):max(row_stop, 0),
+              max(column_start, 0):max(column_stop, 0)] = value
+
+    fill(y0, min(y0 + width, y1 + 1), x0, x1 + 1)
+    fill(max(y1 - width + 1, y0), y1 + 1, x0, x1 + 1)
+    fill(y0, y1 + 1, x0, min(x0 + width, x1 + 1))
+    fill(y0, y1 + 1, max(x1 - width + 1, x0), x1 + 1)
+    return image
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class LumaConverter:
+    '''Convert RGB frames to luma Y = 0.299*R + 0.587*G + 0.114*B with integer fixed-point arithmetic.
+
+    The weights are scaled by 2**16 and the result is rounded to the nearest integer, so the output keeps the dtype of the input (uint8 for RGB8) instead of becoming float64. The integer work buffers are kept between frames and are only reallocated when the frame size changes.
+    '''
+    shift = 16
+    weights = (19595, 38470, 7471)
+
+    def __init__(self):
+        self._accumulator = None
+        self._product = None
+
+    def _work_buffers(self, shape, dtype):
+        # 32 bits are enough for 8 bit channels. Wider channels need 64 bits to avoid overflow.
+        work_dtype = np.uint32 if np.dtype(dtype).itemsize == 1 else np.uint64
+        if self._accumulator is None or self._accumulator.shape != shape or self._accumulator.dtype != work_dtype:
+            self._accumulator = np.empty(shape, dtype=work_dtype)
+            self._product = np.empty(shape, dtype=work_dtype)
+        return self._accumulator, self._product
+
+    def convert(self, rgb):
+        '''rgb is a (height, width, 3) integer array. Return a new (height, width) array with the same dtype.'''
+        if not np.issubdtype(rgb.dtype, np.integer):
+            return 0.299*rgb[:, :, 0] + 0.587*rgb[:, :, 1] + 0.114*rgb[:, :, 2]
+        accumulator, product = self._work_buffers(rgb.shape[:2], rgb.dtype)
+        np.multiply(rgb[:, :, 0], self.weights[0],
+                    out=accumulator, dtype=accumulator.dtype)
+        for channel in (1, 2):
+            np.multiply(rgb[:, :, channel], self.weights[channel],
+                        out=product, dtype=product.dtype)
+            accumulator += product
+        accumulator += 1 << (self.shift - 1)
+        accumulator >>= self.shift
+        # the luma image is published and may still be referenced by the saving queue, so it is not reused between frames
+        return accumulator.astype(rgb.dtype)
+
+
+class OrientationPlan:
+    '''Left-right flip, up-down flip and counterclockwise rotation (applied in this order) folded into one strided view.
+
+    Any combination of the three operations is one of the eight symmetries of a rectangle, which is an optional transpose followed by optional row and column reversals. The plan is worked out once when the settings change and applying it does not copy the image.
+    '''
+
+    def __init__(self, lr_flip=False, ud_flip=False, rotate=0):
+        if rotate not in [0, 90, 180, 270]:
+            raise ValueError('rotate must be 0, 90, 180 or 270.')
+        self.lr_flip = lr_flip
+        self.ud_flip = ud_flip
+        self.rotate = rotate
+        probe = np.arange(6).reshape(2, 3)
+        target = probe
+        if lr_flip:
+            target = np.fliplr(target)
+        if ud_flip:
+            target = np.flipud(target)
+        if rotate:
+            target = np.rot90(target, int(rotate/90))
+        for transpose in (False, True):
+            for row_step in (1, -1):
+                for column_step in (1, -1):
+                    candidate = (probe.T if transpose else probe)[
+                        ::row_step, ::column_step]
+                    if candidate.shape == target.shape and np.array_equal(candidate, target):
+                        self.transpose = transpose
+                        self.row_step = row_step
+                        self.column_step = column_step
+                        return
+
+    @property
+    def is_identity(self):
+        return not self.transpose and self.row_step == 1 and self.column_step == 1
+
+    def apply(self, image):
+        if self.transpose:
+            image = image.swapaxes(0, 1)
+        return image[::self.row_step, ::self.column_step]
@@ -0,0 +1,213 @@
+import time
+import queue
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+import numpy as np
+
+
+@dataclass
+class SaveJob:
+    '''Everything needed to write one frame. Nothing is read back from the device at write time.'''
+    basename: str
+    save_paths: list
+    image: np.ndarray
+    log_row: dict
+    flux: np.ndarray = None
+    image_number: int = -1
+    save_format: str = 'tiff'
+    created: float = field(default_factory=time.monotonic)
+
+    @property
+    def nbytes(self):
+        return self.image.nbytes + (self.flux.nbytes if self.flux is not None else 0)
+
+
+class ImageWriter:
+    '''Long-lived writer service with a bounded job queue and a configurable number of worker threads.
+
+    write_function(job) does the actual writing. When the queue is full, submit() blocks the caller until a slot is free, which slows the producer down to the disk speed instead of growing the memory without limit.
+    '''
+
+    rate_window = 10
+
+    def __init__(self, write_function, max_queue_size=64, workers=1, logger=None):
+        self.write_function = write_function
+        self.logger = logger
+        self._jobs = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._written = deque()
+        self._next_id = 0
+        self._workers = 0
+        self.failed = 0
+        self.set_workers(workers)
+
+    @property
+    def max_queue_size(self):
+        return self._jobs.maxsize
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def set_workers(self, number):
+        if number < 1:
+            raise ValueError('At least one worker is needed.')
+        for _ in range(number - self._workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        # surplus workers exit when they get a None job
+        for _ in range(self._workers - number):
+            self._jobs.put((None, None))
+        self._workers = number
+
+    def submit(self, job):
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            self._pending[job_id] = job.created
+        try:
+            self._jobs.put_nowait((job_id, job))
+        except queue.Full:
+            if self.logger is not None:
+                self.logger.warning(
+                    f'Saving queue is full ({self.max_queue_size} frames). Waiting for the disk.')
+            self._jobs.put((job_id, job))
+
+    def _work(self):
+        while True:
+            job_id, job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                self.write_function(job)
+                with self._lock:
+                    self._written.append((time.monotonic(), job.nbytes))
+            except Exception as e:
+                self.failed += 1
+                if self.logger is not None:
+                    self.logger.error(f'Failed to save {job.basename}: {e}')
+            finally:
+                with self._lock:
+                    self._pending.pop(job_id, None)
+
+    @property
+    def queue_depth(self):
+        '''jobs waiting or being written.'''
+        return len(self._pending)
+
+    @property
+    def bytes_per_second(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._written and self._written[0][0] < now - self.rate_window:
+                self._written.popleft()
+            return sum(i[1] for i in self._written) / self.rate_window
+
+    @property
+    def oldest_pending_age(self):
+        '''seconds since the oldest job still waiting or being written was created.'''
+        with self._lock:
+            if not self._pending:
+                return 0.0
+            # dict keeps the insertion order, so the first pending job is the oldest
+            return time.monotonic() - next(iter(self._pending.values()))
+
+    def join(self, timeout=None):
+        '''wait until all submitted jobs are written.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue_depth:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self, timeout=5):
+        '''write the remaining jobs and let all workers exit.'''
+        self.join(timeout)
+        for _ in range(self._workers):
+            self._jobs.put((None, None))
+        self._workers = 0
+
+
+class SaveWindow:
+    '''Hold each job for `window` seconds before passing it to the writer.
+
+    A job is only written if no other frame arrived within `window` seconds before or after it. When a newer frame arrives too early, the held job is discarded in memory, so nothing has to be removed from the disk afterwards. The arrival time is job.created. The held job is committed `window` seconds after the later of its arrival and its offer, so a job offered late (frames waiting in the frame buffer) still waits for the frames grabbed right after it. With window <= 0, jobs go to the writer directly.
+    '''
+
+    def __init__(self, writer, window=0, logger=None):
+        self.writer = writer
+        self.window = window
+        self.logger = logger
+        self.discarded = 0
+        self._condition = threading.Condition()
+        self._pending = None
+        self._deadline = None
+        self._last_arrival = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._commit_loop, daemon=True)
+        self._thread.start()
+
+    def offer(self, job):
+        with self._condition:
+            if self._closed:
+                self.discarded += 1
+                if self.logger is not None:
+                    self.logger.info(
+                        f"{job.basename} is not saved. The saving is shut down.")
+                return
+            if self._pending is not None and job.created < self._pending.created + self.window:
+                self._discard(self._pending)
+                self._pending = None
+            elif self._pending is not None:
+                self.writer.submit(self._pending)
+                self._pending = None
+            is_isolated = self._last_arrival is None or job.created - \
+                self._last_arrival >= self.window
+            self._last_arrival = job.created
+            if self.window <= 0:
+                self.writer.submit(job)
+            elif is_isolated:
+                self._pending = job
+                self._deadline = max(
+                    job.created, time.monotonic()) + self.window
+                self._condition.notify()
+            else:
+                self._discard(job)
+
+    def _discard(self, job):
+        self.discarded += 1
+        if self.logger is not None:
+            self.logger.info(
+                f"{job.basename} is not saved. Frames came within the save interval {self.window} s.")
+
+    def _commit_loop(self):
+        with self._condition:
+            while not self._closed:
+                if self._pending is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                job, self._pending = self._pending, None
+                self.writer.submit(job)
+
+    def flush(self):
+        '''write the held job now.'''
+        with self._condition:
+            if self._pending is not None:
+                self.writer.submit(self._pending)
+                self._pending = None
+
+    def close(self, timeout=5):
+        '''write the held job and stop the commit thread. Jobs offered afterwards are discarded.'''
+        with self._condition:
+            self._closed = True
+            if self._pending is not None:
+                self.writer.submit(self._pending)
+                self._pending = None
+            self._condition.notify()
+        self._thread.join(timeout)
@@ -0,0 +1,65 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+def draw_dash_line(draw, start, end, fill=255, width=5, period_length=40, ratio=0.5):
+    number = int(((end[0] - start[0])**2 +
+                 (end[1] - start[1])**2)**0.5/period_length)
+    arc = np.arctan2(end[1] - start[1], end[0] - start[0])
+    dx, dy = period_length*np.cos(arc), period_length*np.sin(arc)
+    for i in range(number):
+        line_start = (np.array(start)+[i*dx, i*dy]).astype(int)
+        line_end = (np.array(start) +
+                    [i*dx+dx*ratio, i*dy+dy*ratio]).astype(int)
+        draw.line([tuple(line_start), tuple(line_end)],
+                  fill=fill, width=width)
+
+
+class MarkOverlay:
+    '''Vertical dashed marks with text labels, e.g. the MeV marks of the electron spectrometer camera.
+
+    The marks are rendered once into a boolean mask for a given image shape and dtype. Each frame is then composited with a single vectorized assignment, the marked pixels being set to the maximum of the frame. The mask is only rebuilt when the image geometry changes or when the marks are changed with set_marks().
+    '''
+
+    def __init__(self, labels, positions, font_path="arial.ttf", font_size=80, label_step=50):
+        self.font_path = font_path
+        self.font_size = font_size
+        self.label_step = label_step
+        self._font = None
+        self.set_marks(labels, positions)
+
+    def set_marks(self, labels, positions):
+        self.labels = [str(i) for i in labels]
+        self.positions = [int(i) for i in positions]
+        self._key = None
+        self._indices = None
+
+    def _load_font(self):
+        if self._font is None:
+            try:
+                self._font = ImageFont.truetype(self.font_path, self.font_size)
+            except OSError:
+                self._font = ImageFont.load_default()
+        return self._font
+
+    def _build(self, shape):
+        height, width = shape[:2]
+        mask = Image.new('L', (width, height), 0)
+        draw = ImageDraw.Draw(mask)
+        font = self._load_font()
+        for idx, (label, x) in enumerate(zip(self.labels, self.positions)):
+            draw_dash_line(draw, [x, 0], [x, width])
+            draw.text((x-70, height-idx*self.label_step),
+                      label, font=font, fill=255)
+        self._indices = np.flatnonzero(np.asarray(mask))
+
+    def apply(self, image):
+        '''return a copy of the 2D image with the marks drawn on it.'''
+        key = (image.shape, image.dtype)
+        if key != self._key:
+            self._build(image.shape)
+            self._key = key
+        marked = np.array(image, copy=True, order='C')
+        if image.size:
+            marked.flat[self._indices] = image.max()
+        return marked
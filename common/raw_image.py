@@ -0,0 +1,173 @@
+'''Reading of uncompressed images without a decoder.
+
+The pixels of an uncompressed TIFF (strips or tiles) or of a headerless raw file are copied from the file straight into the output array, or mapped with np.memmap, instead of going through PIL and np.array. Files that need decoding (compression, bit depths below 8, palettes) give None, and the caller falls back to PIL.
+'''
+import os
+import math
+import numpy as np
+
+raw_extensions = ('.raw', '.bin')
+_tiff_types = {3: 'H', 4: 'I', 16: 'Q'}
+_sample_formats = {1: 'u', 2: 'i', 3: 'f'}
+# combinations PIL reads the same way, so that the fast path gives the same arrays
+_supported = {(8, 'u'), (16, 'u'), (16, 'i'), (32, 'i'), (32, 'f'), (64, 'f')}
+
+
+class RawLayout:
+    '''shape, dtype and the (offset, byte count) of every strip or tile of an image in its file.'''
+
+    def __init__(self, shape, dtype, offsets, counts, tile_shape=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.offsets = [int(o) for o in offsets]
+        self.counts = [int(c) for c in counts]
+        self.tile_shape = tile_shape
+
+    @property
+    def nbytes(self):
+        return math.prod(self.shape) * self.dtype.itemsize
+
+    @property
+    def contiguous(self):
+        '''the pixels are one block of the file.'''
+        if self.tile_shape is not None:
+            return False
+        return all(self.offsets[i] + self.counts[i] == self.offsets[i + 1] for i in range(len(self.offsets) - 1)) and sum(self.counts) >= self.nbytes
+
+
+def parse_raw_format(text):
+    '''RawLayout of a headerless file from "dtype,height,width[,header bytes]", e.g. "uint16,2048,2048".'''
+    parts = [p.strip() for p in text.split(',')]
+    if len(parts) not in (3, 4):
+        raise ValueError('raw format must be dtype,height,width[,header bytes].')
+    dtype = np.dtype(parts[0])
+    height, width = int(parts[1]), int(parts[2])
+    offset = int(parts[3]) if len(parts) == 4 else 0
+    return RawLayout((height, width), dtype, [offset], [height * width * dtype.itemsize])
+
+
+def _tiff_value(f, order, type_code, count, field, big):
+    '''values of one IFD entry. field is the raw value/offset field.'''
+    size = {3: 2, 4: 4, 16: 8}.get(type_code)
+    if size is None:
+        return None
+    dtype = np.dtype(order + _tiff_types[type_code])
+    if count * size <= len(field):
+        return np.frombuffer(field[:count * size], dtype).tolist()
+    f.seek(int(np.frombuffer(field, order + ('Q' if big else 'I'))[0]))
+    return np.frombuffer(f.read(count * size), dtype).tolist()
+
+
+def tiff_layout(f):
+    '''RawLayout of the first page of an open TIFF file, or None if its pixels need decoding.'''
+    f.seek(0)
+    header = f.read(16)
+    if header[:2] == b'II':
+        order = '<'
+    elif header[:2] == b'MM':
+        order = '>'
+    else:
+        return None
+    version = int(np.frombuffer(header[2:4], order + 'H')[0])
+    if version == 42:
+        big, ifd = False, int(np.frombuffer(header[4:8], order + 'I')[0])
+    elif version == 43:
+        big, ifd = True, int(np.frombuffer(header[8:16], order + 'Q')[0])
+    else:
+        return None
+    f.seek(ifd)
+    entry_count = int(np.frombuffer(f.read(8 if big else 2), order + ('Q' if big else 'H'))[0])
+    entry_size = 20 if big else 12
+    entries = f.read(entry_count * entry_size)
+    tags = {}
+    for i in range(entry_count):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, type_code = np.frombuffer(entry[:4], order + 'H')
+        count = int(np.frombuffer(entry[4:12] if big else entry[4:8], order + ('Q' if big else 'I'))[0])
+        tags[int(tag)] = (int(type_code), count, entry[12:] if big else entry[8:])
+    values = {}
+    for tag in (256, 257, 258, 259, 262, 273, 277, 278, 279, 284, 322, 323, 324, 325, 339):
+        if tag in tags:
+            values[tag] = _tiff_value(f, order, *tags[tag], big)
+            if values[tag] is None:
+                return None
+    get = lambda tag, default: values.get(tag, [default])
+    width, height = get(256, 0)[0], get(257, 0)[0]
+    samples = get(277, 1)[0]
+    bits = set(get(258, 1))
+    sample_format = _sample_formats.get(get(339, 1)[0])
+    if get(259, 1)[0] != 1 or len(bits) != 1 or get(262, 1)[0] not in (1, 2) or not width or not height:
+        return None
+    bits = bits.pop()
+    if (bits, sample_format) not in _supported or (samples > 1 and (bits != 8 or get(284, 1)[0] != 1)):
+        return None
+    dtype = np.dtype(order + sample_format + str(bits // 8))
+    shape = (height, width, samples) if samples > 1 else (height, width)
+    if 324 in values:
+        return RawLayout(shape, dtype, values[324], values.get(325, []), (get(323, 0)[0], get(322, 0)[0]))
+    if 273 not in values or 279 not in values:
+        return None
+    return RawLayout(shape, dtype, values[273], values[279])
+
+
+def layout_of(path, f, raw_format=''):
+    if raw_format and path.lower().endswith(raw_extensions):
+        return parse_raw_format(raw_format)
+    if path.lower().endswith(('.tif', '.tiff')):
+        return tiff_layout(f)
+    return None
+
+
+def _check_size(f, layout):
+    size = os.fstat(f.fileno()).st_size
+    if any(o + c > size for o, c in zip(layout.offsets, layout.counts)) or (layout.contiguous and layout.offsets[0] + layout.nbytes > size):
+        # FileCompletion retries, the file may still be written
+        raise ValueError('the file is shorter than its image data.')
+
+
+def read_layout(f, layout, out=None):
+    '''read the pixels into out (a uint8 buffer of at least layout.nbytes) or into a new array. The result is in native byte order.'''
+    _check_size(f, layout)
+    if out is not None and out.nbytes >= layout.nbytes:
+        image = np.ndarray(layout.shape, layout.dtype.newbyteorder('='), buffer=out)
+    else:
+        image = np.empty(layout.shape, layout.dtype.newbyteorder('='))
+    target = image.reshape(-1).view(np.uint8)
+    if layout.contiguous:
+        f.seek(layout.offsets[0])
+        f.readinto(memoryview(target))
+    elif layout.tile_shape is None:
+        position = 0
+        for offset, count in zip(layout.offsets, layout.counts):
+            count = min(count, layout.nbytes - position)
+            f.seek(offset)
+            f.readinto(memoryview(target[position:position + count]))
+            position += count
+    else:
+        tile_length, tile_width = layout.tile_shape
+        height, width = layout.shape[:2]
+        tiles_across = -(-width // tile_width)
+        tile = np.empty((tile_length, tile_width) + layout.shape[2:], image.dtype)
+        for i, (offset, count) in enumerate(zip(layout.offsets, layout.counts)):
+            top, left = (i // tiles_across) * tile_length, (i % tiles_across) * tile_width
+            if top >= height:
+                break
+            f.seek(offset)
+            f.readinto(memoryview(tile.reshape(-1).view(np.uint8))[:count])
+            rows, columns = min(tile_length, height - top), min(tile_width, width - left)
+            image[top:top + rows, left:left + columns] = tile[:rows, :columns]
+    if not layout.dtype.isnative:
+        image.byteswap(inplace=True)
+    return image
+
+
+def read_uncompressed(path, raw_format='', out=None, mmap=False):
+    '''image of an uncompressed TIFF or raw file, or None if it needs a decoder. With mmap, a contiguous image is returned as a read-only np.memmap instead of being read.'''
+    with open(path, 'rb') as f:
+        layout = layout_of(path, f, raw_format)
+        if layout is None:
+            return None
+        if mmap and layout.contiguous:
+            _check_size(f, layout)
+            return np.memmap(path, layout.dtype, 'r', layout.offsets[0], layout.shape)
+        return read_layout(f, layout, out)
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+import datetime
+import numpy as np
+import h5py
+
+# save_format values. 'tiff' writes one file per frame, the others append the frames to one HDF5 file per run.
+save_formats = {'tiff': None, 'hdf5': None, 'hdf5_compressed': 'lzf'}
+
+
+def _setting_dtype(value):
+    '''type of a settings column, decided from its first value. The values may be strings, e.g. the log row of Basler.get_settings. Every numeric column is float64, so that a setting such as gain can go from '0' to '1.5' within a run.'''
+    try:
+        float(value)
+        return np.float64
+    except (TypeError, ValueError):
+        return h5py.string_dtype()
+
+
+def _convert_setting(value, dtype):
+    '''value for a settings column. Raise ValueError if a numeric column gets something that is not a number.'''
+    if dtype == np.float64:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{value!r} is not a number.')
+    return '' if value is None else str(value)
+
+
+class HDF5RunWriter:
+    '''Append the frames of one run to a chunked HDF5 file.
+
+    Layout of the file:
+    image (n, height, width), one chunk per frame.
+    flux (n, height, width), only for calibrated cameras.
+    settings (n,), a table with one typed column per settings key.
+    basename (n,), the file name the frame would have had as a single file.
+    image_number (n,), used to find a frame by its image number.
+    The file is flushed every flush_interval seconds, so a crash loses at most the last few frames.
+    A numeric setting that is missing or is not a number is logged and stored as NaN, and the frame is still saved. A missing text setting is stored as an empty string.
+    '''
+
+    def __init__(self, path, compression=None, flush_interval=5, logger=None):
+        self.path = path
+        self.logger = logger
+        self.compression = compression
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._file = h5py.File(path, 'a')
+        self._last_flush = time.monotonic()
+        self.frame_count = len(
+            self._file['image']) if 'image' in self._file else 0
+
+    def _create_frame_dataset(self, name, frame):
+        self._file.create_dataset(name, shape=(0,) + frame.shape, maxshape=(None,) + frame.shape, dtype=frame.dtype,
+                                  chunks=(1,) + frame.shape, compression=self.compression)
+
+    def _create_datasets(self, image, settings, flux):
+        self._create_frame_dataset('image', image)
+        if flux is not None:
+            self._create_frame_dataset('flux', flux)
+        settings_dtype = np.dtype([(key, _setting_dtype(value))
+                                  for key, value in settings.items()])
+        self._file.create_dataset('settings', shape=(0,), maxshape=(
+            None,), dtype=settings_dtype, chunks=(256,))
+        self._file.create_dataset('basename', shape=(0,), maxshape=(
+            None,), dtype=h5py.string_dtype(), chunks=(256,))
+        self._file.create_dataset('image_number', shape=(0,), maxshape=(
+            None,), dtype=np.int64, chunks=(256,))
+        self._file.attrs['created'] = datetime.datetime.now().isoformat()
+
+    def accepts(self, image):
+        '''whether the frame fits in this run. A new run is needed after a change of the image size or dtype.'''
+        if 'image' not in self._file:
+            return True
+        dataset = self._file['image']
+        return dataset.shape[1:] == image.shape and dataset.dtype == image.dtype
+
+    def append(self, image, settings, basename='', image_number=-1, flux=None):
+        image = np.asarray(image)
+        with self._lock:
+            if 'image' not in self._file:
+                self._create_datasets(image, settings, flux)
+            index = self.frame_count
+            for name, data in [('image', image), ('flux', flux)]:
+                if data is not None and name in self._file:
+                    dataset = self._file[name]
+                    dataset.resize(index + 1, axis=0)
+                    dataset[index] = data
+            table = self._file['settings']
+            row = np.zeros((), dtype=table.dtype)
+            for key in table.dtype.names:
+                dtype = table.dtype.fields[key][0]
+                try:
+                    row[key] = _convert_setting(settings.get(key), dtype)
+                except ValueError as e:
+                    row[key] = np.nan
+                    if self.logger is not None:
+                        self.logger.warning(
+                            f'Setting {key} of frame {index} in {self.path} is stored as NaN: {e}')
+            table.resize(index + 1, axis=0)
+            table[index] = row
+            self._file['basename'].resize(index + 1, axis=0)
+            self._file['basename'][index] = basename
+            self._file['image_number'].resize(index + 1, axis=0)
+            self._file['image_number'][index] = image_number
+            self.frame_count = index + 1
+            if time.monotonic() - self._last_flush > self.flush_interval:
+                self._file.flush()
+                self._last_flush = time.monotonic()
+        return index
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+
+
+def new_run_path(folder, prefix='run'):
+    return os.path.join(folder, f'{prefix}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")}.h5')
+
+
+def read_frame(path, image_number, dataset='image'):
+    '''read one frame of a run file by its image number. Return the frame and its settings row.'''
+    with h5py.File(path, 'r') as f:
+        indices = np.flatnonzero(f['image_number'][()] == image_number)
+        if not len(indices):
+            raise KeyError(f'image number {image_number} is not in {path}')
+        index = indices[-1]
+        return f[dataset][index], f['settings'][index]
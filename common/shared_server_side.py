@@ -1,8 +1,25 @@
+import time
 import numpy as np
 from skimage.morphology import erosion, reconstruction
 from skimage.morphology.footprints import square
 from tango import AttrWriteType
 from tango.server import attribute
+from common.center_of_mass import ProjectionCenterOfMass, IntensityDistribution, apply_mask, remove_small_components
+
+
+# beam metrics published with the center of mass: name -> (label, unit, doc, moments attribute)
+beam_metrics = {
+    'beam_total': ('beam total', '', 'Sum of the pixel values that pass the CoM filter.', 'total'),
+    'beam_peak': ('beam peak', '', 'Highest pixel value that passes the CoM filter.', 'peak'),
+    'beam_peak_x': ('beam peak x', 'pixel', 'x coordinate of beam_peak.', 'peak_x'),
+    'beam_peak_y': ('beam peak y', 'pixel', 'y coordinate of beam_peak.', 'peak_y'),
+    'beam_d4sigma_x': ('beam D4sigma x', 'pixel', 'Second-moment beam width along x (4 sigma).', 'd4sigma_x'),
+    'beam_d4sigma_y': ('beam D4sigma y', 'pixel', 'Second-moment beam width along y (4 sigma).', 'd4sigma_y'),
+    'beam_d4sigma_major': ('beam D4sigma major', 'pixel', 'Second-moment beam width along the major axis of the beam ellipse (ISO 11146).', 'd4sigma_major'),
+    'beam_d4sigma_minor': ('beam D4sigma minor', 'pixel', 'Second-moment beam width along the minor axis of the beam ellipse (ISO 11146).', 'd4sigma_minor'),
+    'beam_ellipticity': ('beam ellipticity', '', 'beam_d4sigma_minor / beam_d4sigma_major. 1 for a round beam.', 'ellipticity'),
+    'beam_orientation': ('beam orientation', 'deg', 'Angle from the x axis to the major axis, clockwise on screen since y points down.', 'orientation'),
+}
 
 
 def add_center_of_mass_functions(cls):
@@ -11,7 +28,8 @@ def add_center_of_mass_functions(cls):
     The decorated class should call ``self.initialize_center_of_mass_attributes()``
     from ``initialize_dynamic_attributes()`` when the center-of-mass attributes
     should be exposed. It should also call ``self.calculate_center_of_mass()`` after updating
-    ``self._image``.
+    ``self._image``. The widths, peak and total of the beam (``beam_metrics``) are computed
+    in the same pass and published as change events.
     """
     cls.initialize_center_of_mass_attributes = initialize_center_of_mass_attributes
     cls.read_center_of_mass_x = read_center_of_mass_x
@@ -26,6 +44,22 @@ def add_center_of_mass_functions(cls):
     cls.write_CoM_filter_percentile_high = write_CoM_filter_percentile_high
     cls.read_remove_small_objects = read_remove_small_objects
     cls.write_remove_small_objects = write_remove_small_objects
+    cls.read_small_object_engine = read_small_object_engine
+    cls.write_small_object_engine = write_small_object_engine
+    cls.read_small_object_min_area = read_small_object_min_area
+    cls.write_small_object_min_area = write_small_object_min_area
+    cls.read_small_object_binning = read_small_object_binning
+    cls.write_small_object_binning = write_small_object_binning
+    cls.read_roi_tracking = read_roi_tracking
+    cls.write_roi_tracking = write_roi_tracking
+    cls.read_roi_size = read_roi_size
+    cls.write_roi_size = write_roi_size
+    cls.read_roi_min_fraction = read_roi_min_fraction
+    cls.write_roi_min_fraction = write_roi_min_fraction
+    cls.read_roi = read_roi
+    cls.roi_slices = roi_slices
+    for name in beam_metrics:
+        setattr(cls, f'read_{name}', _beam_metric_reader(name))
     cls.calculate_center_of_mass = calculate_center_of_mass
     return cls
 
@@ -98,7 +132,79 @@ def initialize_center_of_mass_attributes(self):
         access=AttrWriteType.READ_WRITE,
         memorized=True,
         hw_memorized=True,
-        doc='Use erosion and reconstruction to remove small bright objects before calculating the center of mass.',
+        doc='Remove small bright objects before calculating the center of mass. The method is chosen by small_object_engine.',
+    )
+
+    small_object_engine = attribute(
+        name='small_object_engine',
+        label="small object engine",
+        dtype=str,
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='"reconstruction": grayscale erosion and reconstruction. "labeling": drop connected regions of the filter mask smaller than small_object_min_area, much faster on large images.',
+    )
+
+    small_object_min_area = attribute(
+        name='small_object_min_area',
+        label="small object min area",
+        dtype=int,
+        unit='pixel',
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='Regions of the filter mask with fewer pixels are removed by the "labeling" engine.',
+    )
+
+    small_object_binning = attribute(
+        name='small_object_binning',
+        label="small object binning",
+        dtype=int,
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='1, 2 or 4. The "labeling" engine labels the mask binned by this factor.',
+    )
+
+    roi_tracking = attribute(
+        name='roi_tracking',
+        label="roi tracking",
+        dtype=bool,
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='Analyse only a window around the beam of the previous frame. The whole frame is searched again (and the CoM filter thresholds are updated) when the beam gets close to the window edge or its intensity drops below roi_min_fraction of the last full-frame value.',
+    )
+
+    roi_size = attribute(
+        name='roi_size',
+        label="roi size",
+        dtype=int,
+        unit='pixel',
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='Width and height of the tracking window.',
+    )
+
+    roi_min_fraction = attribute(
+        name='roi_min_fraction',
+        label="roi min fraction",
+        dtype=float,
+        access=AttrWriteType.READ_WRITE,
+        format='8.3f',
+        memorized=True,
+        hw_memorized=True,
+        doc='The whole frame is searched when the intensity in the window is below this fraction of the last full-frame intensity.',
+    )
+
+    roi = attribute(
+        name='roi',
+        label="roi",
+        dtype=(int,),
+        max_dim_x=4,
+        access=AttrWriteType.READ,
+        doc='x, y, width and height of the tracking window in pixels, top left is (0, 0). Empty when ROI tracking is off or the beam is lost.',
     )
 
     self._center_of_mass_x = 0
@@ -110,6 +216,15 @@ def initialize_center_of_mass_attributes(self):
     self._CoM_filter_percentile_high = 1.0
     self._CoM_filter_high_source = 'value'
     self._remove_small_objects = False
+    self._small_object_engine = 'reconstruction'
+    self._small_object_min_area = 9
+    self._small_object_binning = 1
+    self._roi_tracking = False
+    self._roi_size = 256
+    self._roi_min_fraction = 0.5
+    self._roi = None
+    self._roi_reference_intensity = 0.0
+    self.center_of_mass_engine = ProjectionCenterOfMass()
     self.add_attribute(center_of_mass_x)
     self.add_attribute(center_of_mass_y)
     self.add_attribute(CoM_filter_low)
@@ -117,6 +232,30 @@ def initialize_center_of_mass_attributes(self):
     self.add_attribute(CoM_filter_high)
     self.add_attribute(CoM_filter_percentile_high)
     self.add_attribute(remove_small_objects)
+    self.add_attribute(small_object_engine)
+    self.add_attribute(small_object_min_area)
+    self.add_attribute(small_object_binning)
+    self.add_attribute(roi_tracking)
+    self.add_attribute(roi_size)
+    self.add_attribute(roi_min_fraction)
+    self.add_attribute(roi)
+    self._beam_metrics = dict.fromkeys(beam_metrics, 0.0)
+    for name, (label, unit, doc, _) in beam_metrics.items():
+        self.add_attribute(attribute(
+            name=name,
+            label=label,
+            dtype=float,
+            unit=unit,
+            access=AttrWriteType.READ,
+            doc=doc,
+        ))
+        self.set_change_event(name, True, False)
+
+
+def _beam_metric_reader(name):
+    def read_beam_metric(self, attr=None):
+        return self._beam_metrics[name]
+    return read_beam_metric
 
 
 def read_center_of_mass_x(self, attr=None):
@@ -187,24 +326,175 @@ def write_remove_small_objects(self, attr):
     self.calculate_center_of_mass()
 
 
-def update_CoM_filter_low_from_percentile(self, image):
-    self._CoM_filter_low = float(np.percentile(
-        image, self._CoM_filter_percentile_low * 100.0))
+def read_small_object_engine(self, attr=None):
+    return self._small_object_engine
+
+
+def write_small_object_engine(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    if value.lower() not in ['reconstruction', 'labeling']:
+        raise ValueError(
+            'small_object_engine must be "reconstruction" or "labeling".')
+    self._small_object_engine = value.lower()
+    self.calculate_center_of_mass()
+
+
+def read_small_object_min_area(self, attr=None):
+    return self._small_object_min_area
+
+
+def write_small_object_min_area(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    if value < 1:
+        raise ValueError('small_object_min_area must be positive.')
+    self._small_object_min_area = int(value)
+    self.calculate_center_of_mass()
+
+
+def read_small_object_binning(self, attr=None):
+    return self._small_object_binning
+
+
+def write_small_object_binning(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    if value not in [1, 2, 4]:
+        raise ValueError('small_object_binning must be 1, 2 or 4.')
+    self._small_object_binning = int(value)
+    self.calculate_center_of_mass()
+
+
+def read_roi_tracking(self, attr=None):
+    return self._roi_tracking
+
+
+def write_roi_tracking(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    self._roi_tracking = bool(value)
+    self._roi = None
+    self.calculate_center_of_mass()
+
+
+def read_roi_size(self, attr=None):
+    return self._roi_size
+
+
+def write_roi_size(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    if value < 16:
+        raise ValueError('roi_size must be at least 16.')
+    self._roi_size = int(value)
+    self._roi = None
+
+
+def read_roi_min_fraction(self, attr=None):
+    return self._roi_min_fraction
+
+
+def write_roi_min_fraction(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    value = float(value)
+    if not 0.0 <= value <= 1.0:
+        raise ValueError('roi_min_fraction must be within [0, 1].')
+    self._roi_min_fraction = value
+
+
+def read_roi(self, attr=None):
+    if self._roi is None:
+        return []
+    top, left, height, width = self._roi
+    return [left, top, width, height]
+
+
+def update_CoM_filter_low_from_percentile(self, distribution):
+    self._CoM_filter_low = distribution.value_at(
+        self._CoM_filter_percentile_low)
 
 
-def update_CoM_filter_percentile_low_from_filter(self, image):
-    self._CoM_filter_percentile_low = float(
-        np.count_nonzero(image <= self._CoM_filter_low) / image.size)
+def update_CoM_filter_percentile_low_from_filter(self, distribution):
+    self._CoM_filter_percentile_low = distribution.fraction_at_or_below(
+        self._CoM_filter_low)
 
 
-def update_CoM_filter_high_from_percentile(self, image):
-    self._CoM_filter_high = float(np.percentile(
-        image, self._CoM_filter_percentile_high * 100.0))
+def update_CoM_filter_high_from_percentile(self, distribution):
+    self._CoM_filter_high = distribution.value_at(
+        self._CoM_filter_percentile_high)
 
 
-def update_CoM_filter_percentile_high_from_filter(self, image):
-    self._CoM_filter_percentile_high = float(
-        np.count_nonzero(image <= self._CoM_filter_high) / image.size)
+def update_CoM_filter_percentile_high_from_filter(self, distribution):
+    self._CoM_filter_percentile_high = distribution.fraction_at_or_below(
+        self._CoM_filter_high)
+
+
+def _masked_center_of_mass(self, image, update_thresholds=True):
+    '''threshold the image, remove small objects and return the BeamMoments, or None if nothing is left.'''
+    if update_thresholds:
+        # both thresholds and their percentiles come from one pass over the image
+        distribution = IntensityDistribution(image)
+        if getattr(self, '_CoM_filter_low_source', 'percentile') == 'value':
+            update_CoM_filter_percentile_low_from_filter(self, distribution)
+        else:
+            update_CoM_filter_low_from_percentile(self, distribution)
+        if getattr(self, '_CoM_filter_high_source', 'value') == 'value':
+            update_CoM_filter_percentile_high_from_filter(self, distribution)
+        else:
+            update_CoM_filter_high_from_percentile(self, distribution)
+    masked_image, mask = apply_mask(
+        image, self._CoM_filter_low, self._CoM_filter_high)
+    if not np.any(mask):
+        return None
+
+    if self._remove_small_objects and self._small_object_engine == 'labeling':
+        # pixels that are 0 carry no weight, but would join everything into one region when the low filter is 0
+        mask = remove_small_components(
+            mask & (masked_image != 0), self._small_object_min_area, self._small_object_binning)
+        masked_image[~mask] = 0
+    elif self._remove_small_objects:
+        masked_image = masked_image.astype(np.float64)
+        seed = erosion(masked_image, square(3))
+        masked_image = reconstruction(seed, masked_image)
+    return self.center_of_mass_engine.compute(masked_image)
+
+
+def _roi_holds_beam(self, result, image_shape):
+    '''whether the beam found in the ROI can be trusted, i.e. it is bright enough and not at an ROI edge that is inside the image.'''
+    if result is None:
+        return False
+    x, y = result.x, result.y
+    if result.total < self._roi_min_fraction * self._roi_reference_intensity:
+        return False
+    top, left, height, width = self._roi
+    margin_y, margin_x = height / 8, width / 8
+    if (top > 0 and y < margin_y) or (left > 0 and x < margin_x):
+        return False
+    if (top + height < image_shape[0] and y > height - margin_y) or (left + width < image_shape[1] and x > width - margin_x):
+        return False
+    return True
+
+
+def _roi_fits(self, image_shape):
+    '''whether the ROI of the previous frame is still valid for an image of this shape.'''
+    if self._roi is None:
+        return False
+    top, left, height, width = self._roi
+    return (height, width) == (min(self._roi_size, image_shape[0]), min(self._roi_size, image_shape[1])) and \
+        top + height <= image_shape[0] and left + width <= image_shape[1]
+
+
+def _place_roi(self, x, y, image_shape):
+    '''center the ROI on (x, y), shifted to stay inside the image.'''
+    height, width = min(self._roi_size, image_shape[0]), min(
+        self._roi_size, image_shape[1])
+    top = int(np.clip(round(y - height / 2), 0, image_shape[0] - height))
+    left = int(np.clip(round(x - width / 2), 0, image_shape[1] - width))
+    self._roi = (top, left, height, width)
+
+
+def roi_slices(self):
+    '''(rows, columns) slices of the ROI for other beam metrics, or the whole image when ROI tracking is off.'''
+    if not getattr(self, '_roi_tracking', False) or getattr(self, '_roi', None) is None:
+        return slice(0, None), slice(0, None)
+    top, left, height, width = self._roi
+    return slice(top, top + height), slice(left, left + width)
 
 
 def calculate_center_of_mass(self):
@@ -215,46 +505,46 @@ def calculate_center_of_mass(self):
             self._center_of_mass_y = 0
             self._CoM_filter_low = 0.0
             self._CoM_filter_high = 999999.0
+            self._roi = None
             return
 
-        image = image.astype(np.float64, copy=False)
-        if not np.isfinite(image).all():
+        # integer images are used in their own dtype. Only float images can contain nan or inf.
+        if np.issubdtype(image.dtype, np.floating) and not np.isfinite(image).all():
             self._center_of_mass_x = 0
             self._center_of_mass_y = 0
             self._CoM_filter_low = 0.0
             self._CoM_filter_high = 999999.0
+            self._roi = None
             return
 
-        if getattr(self, '_CoM_filter_low_source', 'percentile') == 'value':
-            update_CoM_filter_percentile_low_from_filter(self, image)
-        else:
-            update_CoM_filter_low_from_percentile(self, image)
-        if getattr(self, '_CoM_filter_high_source', 'value') == 'value':
-            update_CoM_filter_percentile_high_from_filter(self, image)
-        else:
-            update_CoM_filter_high_from_percentile(self, image)
-        mask = (image >= self._CoM_filter_low) & (
-            image <= self._CoM_filter_high)
-        if not np.any(mask):
+        result = None
+        if self._roi_tracking and _roi_fits(self, image.shape):
+            # the thresholds of the last full-frame search are kept, so the work only depends on the ROI size
+            top, left, height, width = self._roi
+            result = _masked_center_of_mass(
+                self, image[top:top + height, left:left + width], update_thresholds=False)
+            if not _roi_holds_beam(self, result, image.shape):
+                result = None
+        if result is None:
+            top, left = 0, 0
+            result = _masked_center_of_mass(self, image)
+            if result is not None:
+                self._roi_reference_intensity = result.total
+        if result is None:
             max_index = np.unravel_index(np.argmax(image), image.shape)
             self._center_of_mass_x = float(max_index[1])
             self._center_of_mass_y = float(max_index[0])
+            self._roi = None
             return
 
-        masked_image = image * mask
-        if self._remove_small_objects:
-            seed = erosion(masked_image, square(3))
-            masked_image = reconstruction(seed, masked_image)
-        total_intensity = np.sum(masked_image)
-        if total_intensity <= 0:
-            max_index = np.unravel_index(np.argmax(image), image.shape)
-            self._center_of_mass_x = float(max_index[1])
-            self._center_of_mass_y = float(max_index[0])
-            return
-
-        yy, xx = np.indices(image.shape)
-        self._center_of_mass_x = np.sum(xx * masked_image) / total_intensity
-        self._center_of_mass_y = np.sum(yy * masked_image) / total_intensity
+        result = result.shifted(left, top)
+        self._center_of_mass_x = result.x
+        self._center_of_mass_y = result.y
+        if self._roi_tracking:
+            _place_roi(self, self._center_of_mass_x,
+                       self._center_of_mass_y, image.shape)
+        else:
+            self._roi = None
         self.push_change_event(
             "center_of_mass_x", self.read_center_of_mass_x())
         self.push_change_event(
@@ -267,3 +557,211 @@ def calculate_center_of_mass(self):
                                self.read_CoM_filter_high())
         self.push_change_event("CoM_filter_percentile_high",
                                self.read_CoM_filter_percentile_high())
+        self.push_change_event("roi", self.read_roi())
+        for name, (_, _, _, field) in beam_metrics.items():
+            self._beam_metrics[name] = float(getattr(result, field))
+            self.push_change_event(name, self._beam_metrics[name])
+
+
+def add_preview_functions(cls):
+    """Add a decimated, 8 bit preview image attribute to an image Tango device class.
+
+    The decorated class should call ``self.initialize_preview_attributes()``
+    from ``initialize_dynamic_attributes()`` and ``self.publish_preview()`` after updating
+    ``self._image``. The preview is only computed when it is due according to ``preview_max_rate``.
+    """
+    cls.initialize_preview_attributes = initialize_preview_attributes
+    cls.read_preview = read_preview
+    cls.read_preview_max_edge = read_preview_max_edge
+    cls.write_preview_max_edge = write_preview_max_edge
+    cls.read_preview_binning = read_preview_binning
+    cls.write_preview_binning = write_preview_binning
+    cls.read_preview_max_rate = read_preview_max_rate
+    cls.write_preview_max_rate = write_preview_max_rate
+    cls.publish_preview = publish_preview
+    return cls
+
+
+def initialize_preview_attributes(self):
+    preview = attribute(
+        name='preview',
+        label="preview",
+        max_dim_x=10000,
+        max_dim_y=10000,
+        dtype=((np.uint8,),),
+        access=AttrWriteType.READ,
+        doc='Binned copy of the image, scaled to 0-255 between its minimum and maximum. The full resolution image is still available in the image attribute.',
+    )
+
+    preview_max_edge = attribute(
+        name='preview_max_edge',
+        label="preview max edge",
+        dtype=int,
+        access=AttrWriteType.READ_WRITE,
+        unit='pixel',
+        memorized=True,
+        hw_memorized=True,
+        doc='The image is binned by the smallest integer factor that makes its longer edge no larger than this value.',
+    )
+
+    preview_binning = attribute(
+        name='preview_binning',
+        label="preview binning",
+        dtype=str,
+        access=AttrWriteType.READ_WRITE,
+        memorized=True,
+        hw_memorized=True,
+        doc='"mean" or "max" of the pixels in each bin. "max" keeps small bright spots visible.',
+    )
+
+    preview_max_rate = attribute(
+        name='preview_max_rate',
+        label="preview max rate",
+        dtype=float,
+        access=AttrWriteType.READ_WRITE,
+        unit='Hz',
+        memorized=True,
+        hw_memorized=True,
+        doc='Maximum rate of preview change events. 0 publishes every image.',
+    )
+
+    self._preview = np.zeros((1, 1), dtype=np.uint8)
+    self._preview_max_edge = 512
+    self._preview_binning = 'mean'
+    self._preview_max_rate = 2.0
+    self._preview_time = 0.0
+    self.add_attribute(preview)
+    self.add_attribute(preview_max_edge)
+    self.add_attribute(preview_binning)
+    self.add_attribute(preview_max_rate)
+    self.set_change_event('preview', True, False)
+
+
+def read_preview(self, attr=None):
+    return self._preview
+
+
+def read_preview_max_edge(self, attr=None):
+    return self._preview_max_edge
+
+
+def write_preview_max_edge(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    if value < 1:
+        raise ValueError('preview_max_edge must be positive.')
+    self._preview_max_edge = int(value)
+
+
+def read_preview_binning(self, attr=None):
+    return self._preview_binning
+
+
+def write_preview_binning(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    if value.lower() not in ['mean', 'max']:
+        raise ValueError('preview_binning must be "mean" or "max".')
+    self._preview_binning = value.lower()
+
+
+def read_preview_max_rate(self, attr=None):
+    return self._preview_max_rate
+
+
+def write_preview_max_rate(self, attr):
+    value = attr.get_write_value() if hasattr(attr, 'get_write_value') else attr
+    if value < 0:
+        raise ValueError('preview_max_rate must not be negative.')
+    self._preview_max_rate = float(value)
+
+
+def make_preview(image, max_edge=512, binning='mean'):
+    '''bin a 2D image so that its longer edge is at most max_edge and scale it to uint8. An edge shorter than the binning factor is binned to one pixel.'''
+    image = np.squeeze(np.asarray(image))
+    factor = max(1, -(-max(image.shape) // max_edge))
+    if factor > 1:
+        factor_y, factor_x = min(factor, image.shape[0]), min(
+            factor, image.shape[1])
+        height, width = image.shape[0] // factor_y, image.shape[1] // factor_x
+        blocks = image[:height*factor_y, :width *
+                       factor_x].reshape(height, factor_y, width, factor_x)
+        if binning == 'max':
+            image = blocks.max(axis=(1, 3))
+        else:
+            image = blocks.mean(axis=(1, 3), dtype=np.float32)
+    low, high = float(np.min(image)), float(np.max(image))
+    if high <= low:
+        return np.zeros(image.shape, dtype=np.uint8)
+    preview = (image - low) * (255.0 / (high - low))
+    return preview.astype(np.uint8)
+
+
+def publish_preview(self):
+    if not hasattr(self, '_preview_time') or not hasattr(self, '_image'):
+        return
+    now = time.monotonic()
+    if self._preview_max_rate and now - self._preview_time < 1 / self._preview_max_rate:
+        return
+    image = np.squeeze(np.asarray(self._image))
+    if image.ndim != 2 or image.size == 0:
+        return
+    self._preview_time = now
+    self._preview = make_preview(
+        image, self._preview_max_edge, self._preview_binning)
+    self.push_change_event("preview", self.read_preview())
+
+
+def add_stage_timing_functions(cls):
+    """Add per-stage latency attributes of the frame pipeline to an image Tango device class.
+
+    The decorated class should create ``self.stage_timer`` (a ``common.stage_timer.StageTimer``)
+    in ``init_device()``, time its stages with ``self.stage_timer.measure(stage)`` and call
+    ``self.initialize_stage_timing_attributes()`` from ``initialize_dynamic_attributes()``.
+    """
+    cls.initialize_stage_timing_attributes = initialize_stage_timing_attributes
+    cls.read_stage_names = read_stage_names
+    cls.read_stage_latency_p50 = read_stage_latency_p50
+    cls.read_stage_latency_p95 = read_stage_latency_p95
+    cls.read_stage_latency_max = read_stage_latency_max
+    return cls
+
+
+def initialize_stage_timing_attributes(self):
+    number = len(self.stage_timer.stages)
+    stage_names = attribute(
+        name='stage_names',
+        label="stage names",
+        max_dim_x=number,
+        dtype=(str,),
+        access=AttrWriteType.READ,
+        doc='Stages of the frame pipeline, in the order used by the stage_latency attributes.',
+    )
+    stage_latency = {}
+    for statistic in ['p50', 'p95', 'max']:
+        stage_latency[statistic] = attribute(
+            name=f'stage_latency_{statistic}',
+            label=f"stage latency {statistic}",
+            max_dim_x=number,
+            dtype=(float,),
+            unit='ms',
+            access=AttrWriteType.READ,
+            doc=f'{statistic} of the duration of each stage over the last {self.stage_timer.window} frames.',
+        )
+    self.add_attribute(stage_names)
+    for value in stage_latency.values():
+        self.add_attribute(value)
+
+
+def read_stage_names(self, attr=None):
+    return self.stage_timer.stages
+
+
+def read_stage_latency_p50(self, attr=None):
+    return self.stage_timer.percentile_table()[0]
+
+
+def read_stage_latency_p95(self, attr=None):
+    return self.stage_timer.percentile_table()[1]
+
+
+def read_stage_latency_max(self, attr=None):
+    return self.stage_timer.percentile_table()[2]
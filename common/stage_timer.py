@@ -0,0 +1,56 @@
+import time
+from contextlib import contextmanager
+import numpy as np
+
+
+class StageTimer:
+    '''Rolling record of the duration of each stage of the frame pipeline.
+
+    Each stage keeps the last `window` durations in a preallocated array. Recording is a single array store and an integer increment without locks, since every stage is only timed from one thread. Statistics are computed on a copy when they are read.
+    '''
+
+    def __init__(self, stages, window=1000):
+        self.stages = list(stages)
+        self.window = window
+        self._samples = {stage: np.zeros(window) for stage in self.stages}
+        self._count = dict.fromkeys(self.stages, 0)
+
+    def record(self, stage, seconds):
+        count = self._count[stage]
+        self._samples[stage][count % self.window] = seconds
+        self._count[stage] = count + 1
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def statistics(self, stage):
+        '''return (p50, p95, max) in seconds over the window, zeros if the stage never ran.'''
+        number = min(self._count[stage], self.window)
+        if not number:
+            return 0.0, 0.0, 0.0
+        samples = self._samples[stage][:number].copy()
+        p50, p95 = np.percentile(samples, [50, 95])
+        return float(p50), float(p95), float(samples.max())
+
+    def percentile_table(self):
+        '''p50, p95 and max of every stage in ms, as three lists in the order of self.stages.'''
+        table = np.array([self.statistics(stage)
+                         for stage in self.stages]).reshape(-1, 3) * 1000
+        return table[:, 0], table[:, 1], table[:, 2]
+
+    def summary(self):
+        lines = [f'{"stage":<12}{"count":>8}{"p50 (ms)":>12}{"p95 (ms)":>12}{"max (ms)":>12}']
+        for stage in self.stages:
+            p50, p95, maximum = self.statistics(stage)
+            lines.append(
+                f'{stage:<12}{self._count[stage]:>8}{p50*1000:>12.3f}{p95*1000:>12.3f}{maximum*1000:>12.3f}')
+        return '\n'.join(lines)
+
+    def reset(self):
+        for stage in self.stages:
+            self._count[stage] = 0
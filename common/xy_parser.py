@@ -0,0 +1,67 @@
+import warnings
+import numpy as np
+
+header_lines = {1: 6}
+_separators = bytes.maketrans(b',;\t', b'   ')
+
+
+def _line_start(data, marker):
+    '''index of the line that starts with marker, or -1.'''
+    if data.startswith(marker):
+        return 0
+    index = data.find(b'\n' + marker)
+    return index + 1 if index >= 0 else -1
+
+
+def data_section(data, data_structure):
+    '''(start, stop) of the numeric block of a csv file given as bytes.
+
+    Data structure 0 (VISSpec) has its data between a [Data] line and an [EndOfFile] line. Data structure 1 (Lecroy scope) has a header of 6 lines.
+    '''
+    if data_structure == 0:
+        start = _line_start(data, b'[Data]')
+        if start < 0:
+            raise ValueError('no [Data] section.')
+        start = data.find(b'\n', start) + 1 or len(data)
+        stop = _line_start(data[start:], b'[EndOfFile]')
+        return start, start + stop if stop >= 0 else len(data)
+    start = 0
+    for _ in range(header_lines[data_structure]):
+        start = data.find(b'\n', start) + 1
+        if start == 0:
+            return len(data), len(data)
+    return start, len(data)
+
+
+def parse_xy(data, data_structure):
+    '''x and y columns of a csv file given as bytes, as two float64 arrays.
+
+    The numeric block is converted in one pass by np.fromstring after turning the separators (comma, semicolon, tab) into spaces. x is the first column. y is the second column of comma separated files and the last column otherwise, as in the previous row-by-row parser.
+    '''
+    start, stop = data_section(data, data_structure)
+    block = data[start:stop]
+    first_line = block.lstrip().split(b'\n', 1)[0]
+    if not first_line.strip():
+        return np.empty(0), np.empty(0)
+    columns = len(first_line.translate(_separators).split())
+    with warnings.catch_warnings():
+        # numpy < 2 only warns when it stops at text that is not a number
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(block.translate(_separators), dtype=np.float64, sep=' ')
+        except DeprecationWarning as e:
+            raise ValueError(str(e))
+    if values.size % columns:
+        raise ValueError(
+            f'{values.size} values do not fill rows of {columns} columns.')
+    table = values.reshape(-1, columns)
+    y_column = 1 if b',' in first_line and columns > 1 else columns - 1
+    xy = np.empty((2, len(table)))
+    xy[0] = table[:, 0]
+    xy[1] = table[:, y_column]
+    return xy[0], xy[1]
+
+
+def read_xy(path, data_structure):
+    with open(path, 'rb') as f:
+        return parse_xy(f.read(), data_structure)
@@ -0,0 +1,33 @@
+import unittest
+import numpy as np
+from common.center_of_mass import ProjectionCenterOfMass, apply_mask, remove_small_components
+
+
+class TestRemoveSmallComponents(unittest.TestCase):
+    def setUp(self):
+        y, x = np.mgrid[:1000, :1200]
+        self.image = (1000 * np.exp(-((x - 600)**2 + (y - 500)**2) / (2 * 40**2))).astype(np.uint16)
+        self.image[50, 50] = 60000
+
+    def center_of_mass(self, binning):
+        masked, mask = apply_mask(self.image, 0, 65535)
+        kept = remove_small_components(mask & (masked != 0), 9, binning)
+        masked[~kept] = 0
+        return ProjectionCenterOfMass().compute(masked)
+
+    def test_hot_pixel_is_removed(self):
+        for binning in (1, 4):
+            result = self.center_of_mass(binning)
+            self.assertAlmostEqual(result.x, 600, places=3)
+            self.assertAlmostEqual(result.y, 500, places=3)
+
+    def test_area_is_counted_in_pixels_with_binning(self):
+        mask = np.zeros((16, 16), bool)
+        mask[1:4, 1:3] = True
+        self.assertFalse(remove_small_components(mask, 9, 4).any())
+        mask[1:4, 1:4] = True
+        self.assertTrue(remove_small_components(mask, 9, 4)[1:4, 1:4].all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import time
+import unittest
+import numpy as np
+from common.image_writer import SaveJob, SaveWindow
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.written = []
+
+    def submit(self, job):
+        self.written.append(job.basename)
+
+
+class TestSaveWindow(unittest.TestCase):
+    def setUp(self):
+        self.writer = RecordingWriter()
+        self.window = SaveWindow(self.writer, 0.3)
+
+    def tearDown(self):
+        self.window.close()
+
+    def job(self, name, created):
+        return SaveJob(basename=name, save_paths=[], image=np.zeros((2, 2)), log_row={}, created=created)
+
+    def test_isolated_frame_is_written(self):
+        self.window.offer(self.job('A', time.monotonic()))
+        time.sleep(0.5)
+        self.assertEqual(self.writer.written, ['A'])
+
+    def test_close_frames_are_discarded(self):
+        now = time.monotonic()
+        self.window.offer(self.job('A', now))
+        self.window.offer(self.job('B', now + 0.05))
+        time.sleep(0.5)
+        self.assertEqual(self.writer.written, [])
+
+    def test_close_frames_offered_late_are_discarded(self):
+        # both frames were grabbed 0.4 s ago and waited in the frame buffer
+        grabbed = time.monotonic() - 0.4
+        self.window.offer(self.job('A', grabbed))
+        time.sleep(0.01)
+        self.window.offer(self.job('B', grabbed + 0.05))
+        time.sleep(0.5)
+        self.assertEqual(self.writer.written, [])
+
+
+if __name__ == '__main__':
+    unittest.main()